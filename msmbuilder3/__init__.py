@@ -1,5 +1,11 @@
+from base import set_precision, get_precision
 from pca import PCA
 from tica import tICA
 from vectorizer import (AngleVectorizer, DihedralVectorizer,
                          PositionVectorizer, DistanceVectorizer)
 from dataset import DataSet
+from sharded import ShardedDataSet
+from writer import DataSetWriter
+from live import LiveDataSet
+from memory import MemoryDataSet
+from npy import NpyDataSet, export_npy, import_npy
@@ -9,6 +9,43 @@ import tables
 import numpy as np
 import mdtraj as md
 
+# The floating point precision of the features, projections and other
+# per-frame data produced by the library. See `set_precision`.
+_precision = 'single'
+_precision_dtypes = {'single': np.float32, 'double': np.float64}
+
+
+def set_precision(precision):
+    """
+    Set the floating point precision of the data produced by msmbuilder3
+
+    This controls the dtype of the per-frame arrays that the vectorizers,
+    tICA and PCA return, and so what is stored in DataSets, and the default
+    precision of KCenters. Single precision halves the memory and I/O of
+    double precision. Running sums, like the correlation matrices in tICA
+    and PCA, are always accumulated in double precision regardless.
+
+    Parameters
+    ----------
+    precision : {'single', 'double'}
+        The default is 'single'.
+    """
+    global _precision
+    if precision not in _precision_dtypes:
+        raise ValueError("precision must be one of %s" % sorted(_precision_dtypes))
+    _precision = precision
+
+
+def get_precision():
+    """Get the floating point precision of the data produced by msmbuilder3,
+    'single' or 'double'. See `set_precision`."""
+    return _precision
+
+
+def float_dtype(precision=None):
+    """The numpy dtype for `precision`, by default the library-wide precision"""
+    return _precision_dtypes[_precision if precision is None else precision]
+
 
 class BaseModeller(object):
     """
@@ -1,7 +1,7 @@
 import numpy as np
 import mdtraj as md
 import scipy.spatial.distance
-from msmbuilder3.base import BaseModeller, TransformerMixin, EstimatorMixin
+from msmbuilder3.base import BaseModeller, TransformerMixin, EstimatorMixin, float_dtype
 
 
 class KCenters(BaseModeller, EstimatorMixin):
@@ -15,8 +15,10 @@ class KCenters(BaseModeller, EstimatorMixin):
     seed : int, 'random'
         The index of of the data point to use as the 0th cluster center,
         between 0 and n_samples-1.
-    precision = {'single', 'double'}
-        Numerical precision in which to perform the calculation.
+    precision = {'single', 'double', None}
+        Numerical precision in which to perform the calculation. By default,
+        the library-wide precision (see `set_precision`). Data that is
+        already in this precision is used without being copied.
 
     Attributes
     ----------
@@ -32,7 +34,7 @@ class KCenters(BaseModeller, EstimatorMixin):
         The indices, with respect to the original dataset, X, of the data
         points that have been deemed cluster centers.
     """
-    def __init__(self, n_clusters, seed='random', precision='single', metric='euclidean'):
+    def __init__(self, n_clusters, seed='random', precision=None, metric='euclidean'):
         self.n_clusters = n_clusters
         self.seed = seed
         self.precision = precision
@@ -51,7 +53,7 @@ class KCenters(BaseModeller, EstimatorMixin):
         -------
         self
         """
-        dtype = {'single': np.float32, 'double': np.float64}[self.precision]
+        dtype = float_dtype(self.precision)
         X = md.utils.ensure_type(X, dtype, ndim=2, name='X', warn_on_cast=False)
         n_samples, n_features = X.shape
 
@@ -68,7 +70,7 @@ class KCenters(BaseModeller, EstimatorMixin):
 
         for i in xrange(self.n_clusters):
             # KCenters main loop
-            d = scipy.spatial.distance.cdist([X[new_center]], X, metric=self.metric)[0]
+            d = _distances(X, X[new_center], self.metric)
             new_assignments = np.where(d < self.scores_)[0]
             self.scores_[new_assignments] = d[new_assignments]
             self.labels_[new_assignments] = i
@@ -113,7 +115,44 @@ class KCenters(BaseModeller, EstimatorMixin):
         """
         if not hasattr(self, 'centers_'):
             raise RuntimeError('The model must be fit before transform() can be run')
-        dtype = {'single': np.float32, 'double': np.float64}[self.precision]
+        dtype = float_dtype(self.precision)
         X = md.utils.ensure_type(X, dtype, ndim=2, name='X', warn_on_cast=False)
-        d = scipy.spatial.distance.cdist(X, self.centers_, metric=self.metric)
-        return np.argmin(d, axis=1)
+
+        labels = np.zeros(len(X), np.int32)
+        if self.metric != 'euclidean':
+            # cdist converts its input to double precision, so only hand it
+            # one block of rows at a time
+            for start in xrange(0, len(X), _block_size):
+                d = scipy.spatial.distance.cdist(X[start:start+_block_size], self.centers_,
+                                                 metric=self.metric)
+                labels[start:start+_block_size] = np.argmin(d, axis=1)
+            return labels
+
+        scores = np.inf * np.ones(len(X), dtype)
+        for i, center in enumerate(self.centers_.astype(dtype)):
+            d = _distances(X, center, self.metric)
+            closer = np.where(d < scores)[0]
+            scores[closer] = d[closer]
+            labels[closer] = i
+        return labels
+
+
+# The number of samples whose distances are computed at once by _distances
+_block_size = 65536
+
+def _distances(X, center, metric):
+    """The distance between each row of X and `center`
+
+    scipy's cdist converts its input to double precision, which copies the
+    whole of a single precision `X`. For the euclidean metric, the distances
+    are instead computed in the precision of `X`, one block of rows at a
+    time.
+    """
+    if metric != 'euclidean':
+        return scipy.spatial.distance.cdist([center], X, metric=metric)[0]
+
+    d = np.empty(len(X), X.dtype)
+    for start in xrange(0, len(X), _block_size):
+        diff = X[start:start+_block_size] - center
+        d[start:start+_block_size] = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+    return d
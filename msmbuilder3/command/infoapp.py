@@ -6,7 +6,7 @@ import tables
 from IPython.utils.traitlets import Unicode, Int, Enum, Instance
 
 from msmbuilder3.config.app import MSMBuilderApp
-from msmbuilder3 import DataSet
+from msmbuilder3 import DataSet, LiveDataSet
 from msmbuilder3.dataset import UnrecognizedFormatError
 
 class InfoApp(MSMBuilderApp):
@@ -18,6 +18,12 @@ class InfoApp(MSMBuilderApp):
         if not os.path.exists(self.input):
             self.error('No such file or directory: %s' % self.input)
 
+        if os.path.isdir(self.input):
+            ds = LiveDataSet(self.input)
+            self.print_live_dataset(ds)
+            ds.close()
+            return
+
         if not tables.is_pytables_file(self.input):
             self.error('Unrecognized format')
 
@@ -43,7 +49,10 @@ class InfoApp(MSMBuilderApp):
         print 'Mapped Trajectory Dataset'
         print '=========================\n'
         print 'Name: %s' % ds.name
-        print 'Number of trajectories: %s (from index %s to %s)' % (len(ds.keys()), min(keys), max(keys))
+        if len(keys) > 0:
+            print 'Number of trajectories: %s (from index %s to %s)' % (len(keys), keys[0], keys[-1])
+        else:
+            print 'Number of trajectories: 0'
 
         print
         print 'Provenance'
@@ -52,14 +61,44 @@ class InfoApp(MSMBuilderApp):
 
         print 'Dimensionality'
         print '--------------'
-        for i in range(1+min(max(keys), 5)):
-            entry = ds[i, 0]
-            if np.isscalar(entry):
-                print 'trj%s contains %s scalar entries' % (i, ds.length(i))
+        for i in keys[:6]:
+            shape = ds.shape(i)
+            if len(shape) == 1:
+                print 'trj%s contains %s scalar entries' % (i, shape[0])
             else:
-                print 'trj%s contains %s entries of shape %s' % (i, ds.length(i), entry.shape)
+                print 'trj%s contains %s entries of shape %s' % (i, shape[0], shape[1:])
             print '     -> %s' % ds.get_trajfn(i)
 
+        stats = ds.stats
+        if stats is not None:
+            print
+            print 'Summary Statistics'
+            print '------------------'
+            print 'Total number of entries: %d' % stats['count']
+            mean = stats['mean'].reshape(-1)
+            std = np.sqrt(stats['var']).reshape(-1)
+            lo, hi = stats['min'].reshape(-1), stats['max'].reshape(-1)
+            for j in range(min(len(mean), 6)):
+                print 'feature %d: mean=%.4g, std=%.4g, min=%.4g, max=%.4g' % (
+                    j, mean[j], std[j], lo[j], hi[j])
+
+
+    def print_live_dataset(self, ds):
+        keys = ds.keys()
+
+        print 'Live Mapped Trajectory Dataset'
+        print '==============================\n'
+        print 'Status: %s' % ('complete' if ds.closed else 'still being written')
+        print 'Number of published trajectories: %d' % len(keys)
+        print 'Number of published frames: %d' % ds.lengths().sum()
+        print
+
+        print 'Dimensionality'
+        print '--------------'
+        for i in keys[:6]:
+            shape = ds.shape(i)
+            print 'trj%s contains %s entries of shape %s' % (i, shape[0], shape[1:])
+            print '     -> %s' % ds.get_trajfn(i)
 
     def print_model(self, handle):
 
@@ -41,6 +41,12 @@ class KCentersApp(MSMBuilderApp):
         `trained_path`, and use it to assign your dataset. Finally, using
         `fit_transform`, you can run both of these steps together, training
         the model AND using it to assign your dataset.''')
+    encoding = Enum(['rle', 'narrow', 'none'], default_value='rle', config=True,
+        help='''How the assignments are encoded in the output DataSet. With
+        `narrow`, they are stored with the smallest sufficient integer type.
+        With `rle`, they are also run-length encoded, which is much more
+        compact, since trajectories tend to stay in each state for many
+        frames. Either way, they are decoded transparently when read.''')
     classes = [VectorApp, TICAApp]
 
     input_provenance = None
@@ -75,13 +81,15 @@ class KCentersApp(MSMBuilderApp):
 
         elif self.mode in ['fit_predict', 'predict']:
             self.log.info('Writing DataSet: %s' % self.output)
-            dataset = DataSet(self.output, mode='w', name='KCenters')
+            encoding = None if self.encoding == 'none' else self.encoding
+            dataset = DataSet(self.output, mode='w', name='KCenters', encoding=encoding)
             if self.source == 'precomputed':
                 dataset.provenance = self.input_provenance
 
-            for i, (data, fn) in enumerate(self.yield_transform(with_filenames=True)):
-                dataset[i] = data
-                dataset.set_trajfn(i, fn)
+            with dataset.batch():
+                for i, (data, fn) in enumerate(self.yield_transform(with_filenames=True)):
+                    dataset[i] = data
+                    dataset.set_trajfn(i, fn)
             dataset.close()
         else:
             raise RuntimeError(self.mode)
@@ -96,19 +104,35 @@ class KCentersApp(MSMBuilderApp):
                 self.kcenters = KCenters.from_pytables(f.root.KCenters)
 
         else:
-            dataset = []
-            for data, fn in self._yield_input(with_filenames=True):
-                self.breakpoints.append(sum(self.breakpoints) + len(data))
-                self.traj_filenames.append(fn)
-                dataset.append(data)
-            dataset = np.concatenate(dataset)
-
+            dataset = self._load_input()
             self.log.info('** Starting fitting KCenters...')
             self.kcenters.fit(dataset)
             self.log.info('** Finished fitting KCenters')
 
         self.is_fit = True
 
+    def _load_input(self):
+        """Load the whole input dataset as a single array, recording the
+        breakpoints between trajectories and their filenames"""
+        if self.source == 'precomputed':
+            # the DataSet hands us all of the frames at once without building
+            # a list of per-trajectory copies first (and if it was written
+            # with the flat layout, without concatenating anything at all)
+            input = DataSet(self.input)
+            dataset = input.flat()
+            self.breakpoints = input.offsets().tolist()
+            self.traj_filenames = [''] + [input.get_trajfn(key) for key in input.keys()]
+            self.input_provenance = input.provenance
+            input.close()
+            return dataset
+
+        dataset = []
+        for data, fn in self._yield_input(with_filenames=True):
+            self.breakpoints.append(self.breakpoints[-1] + len(data))
+            self.traj_filenames.append(fn)
+            dataset.append(data)
+        return np.concatenate(dataset)
+
     def yield_transform(self, with_filenames=False):
         self.fit()
         n_trajs = len(self.breakpoints)-1
@@ -121,8 +145,11 @@ class KCentersApp(MSMBuilderApp):
 
     def _yield_input(self, with_filenames=False):
         if self.source == 'tICA':
-            for data in self.ticaapp.yield_transform(with_filenames):
-                yield data
+            try:
+                for data in self.ticaapp.yield_transform(with_filenames):
+                    yield data
+            finally:
+                self.ticaapp.close()
         elif self.source == 'vector':
             for data in self.vector.yield_transform(with_filenames):
                 yield data
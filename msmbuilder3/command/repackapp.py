@@ -0,0 +1,175 @@
+import os
+import stat
+import time
+import tempfile
+import collections
+import numpy as np
+from IPython.utils.traitlets import Unicode, Int, Enum, Bool, List
+
+from msmbuilder3.config.app import MSMBuilderApp
+from msmbuilder3 import DataSet
+
+
+class _IntList(List):
+    """A list of ints, which also accepts a single int, since that's what
+    the config loader makes of `--name=10` on the command line"""
+    def __init__(self, **kwargs):
+        super(_IntList, self).__init__(Int, **kwargs)
+
+    def validate(self, obj, value):
+        if isinstance(value, (int, long)):
+            value = [value]
+        return super(_IntList, self).validate(obj, value)
+
+
+class RepackApp(MSMBuilderApp):
+    name = 'repack'
+    path = 'msmbuilder3.command.repackapp.RepackApp'
+    short_description = '''Rewrite a dataset with new chunking, compression or layout'''
+    long_description = '''Copy a DataSet into a new file, trajectory by
+        trajectory and block by block, with a new chunk shape, compression
+        codec, layout, encoding or stride pyramid. The index, provenance,
+        trajectory filenames and recorded source files are carried over.
+        The size of the file and the throughput of reading it back (with a
+        warm page cache, after an untimed pass) are reported before and
+        after. If `output` is the same file as `input`,
+        the input is replaced once the copy has been written.'''
+
+    compression = Unicode('blosc:lz4', config=True, help='''Compression
+        library: one of `blosc`, `blosc:<codec>` (e.g. `blosc:lz4`,
+        `blosc:zstd`, `blosc:blosclz`), `zlib`, or `none`.''')
+    complevel = Int(5, config=True, help='''Compression level, from 1
+        (fastest) to 9 (smallest).''')
+    shuffle = Enum(['byte', 'bit', 'none'], default_value='byte', config=True,
+        help='''Shuffle the bytes or bits of the data before compressing it.''')
+    chunk_frames = Int(0, config=True, help='''Number of frames in each HDF5
+        chunk. If 0, PyTables picks the chunk shape based on the length of
+        each trajectory.''')
+    column_block = Int(0, config=True, help='''If positive, store each chunk
+        with only this many features (columns), which makes reading a few
+        features out of many much cheaper.''')
+    layout = Enum(['keep', 'nodes', 'flat'], default_value='keep', config=True,
+        help='''Layout of the trajectories in the new file. See the DataSet
+        documentation for details.''')
+    encoding = Enum(['keep', 'none', 'narrow', 'rle'], default_value='keep', config=True,
+        help='''Encoding of integer trajectories (like state assignments) in
+        the new file. Encodings are only available with the `nodes` layout,
+        so with `layout=flat`, `keep` decodes the trajectories.''')
+    pyramid = _IntList(config=True, help='''Strides of the strided copies to
+        store along with each trajectory (e.g. `--pyramid=10,100`). By
+        default, those of the input are kept.''')
+    drop_pyramid = Bool(False, config=True, help='''Don't store any strided
+        copies in the new file.''')
+    chunk_size = Int(100000, config=True, help='''Number of frames copied at
+        a time.''')
+
+    def start(self):
+        if not os.path.exists(self.input):
+            self.error('No such file or directory: %s' % self.input)
+
+        input = DataSet(self.input)
+        options = self._dataset_options(input)
+        before_size = os.path.getsize(self.input)
+        before_speed = self._read_throughput(input)
+
+        in_place = os.path.abspath(self.output) == os.path.abspath(self.input)
+        if in_place:
+            fd, output = tempfile.mkstemp(suffix='.h5', dir=os.path.dirname(os.path.abspath(self.output)))
+            os.close(fd)
+        else:
+            output = self.output
+
+        self.log.info('Writing DataSet: %s' % self.output)
+        try:
+            dataset = self._repack(input, output, options)
+            dataset.close()
+            input.close()
+            if in_place:
+                # mkstemp creates the file readable only by us
+                os.chmod(output, stat.S_IMODE(os.stat(self.input).st_mode))
+                os.rename(output, self.output)
+        except:
+            input.close()
+            if in_place and os.path.exists(output):
+                os.unlink(output)
+            raise
+
+        dataset = DataSet(self.output)
+        after_size = os.path.getsize(self.output)
+        after_speed = self._read_throughput(dataset)
+        dataset.close()
+
+        self.log.info('File size:       %10.1f MB -> %10.1f MB' % (before_size / 1e6, after_size / 1e6))
+        self.log.info('Read throughput: %10.1f MB/s -> %8.1f MB/s' % (before_speed, after_speed))
+
+    def _dataset_options(self, input):
+        """Work out the keyword arguments of the new DataSet, checking that
+        they go together before anything is written"""
+        layout = input.layout if self.layout == 'keep' else self.layout
+        encoding = input.encoding if self.encoding == 'keep' else self.encoding
+        if encoding == 'none':
+            encoding = None
+        if layout == 'flat' and encoding is not None:
+            if self.encoding != 'keep':
+                self.error('encoding=%s is only available with layout=nodes' % encoding)
+            self.log.info('Decoding the %s-encoded trajectories for the flat layout' % encoding)
+            encoding = None
+
+        if self.drop_pyramid:
+            pyramid = []
+        elif len(self.pyramid) > 0:
+            pyramid = list(self.pyramid)
+        else:
+            pyramid = input.pyramid
+        if any(k < 2 for k in pyramid):
+            self.error('the pyramid strides must be greater than 1')
+
+        return dict(name=input.name, timestep=input.timestep,
+                    compression=None if self.compression == 'none' else self.compression,
+                    complevel=self.complevel,
+                    shuffle=None if self.shuffle == 'none' else self.shuffle,
+                    chunkshape=self.chunk_frames or None, layout=layout,
+                    encoding=encoding, pyramid=pyramid,
+                    column_block=self.column_block or None)
+
+    def _repack(self, input, output, options):
+        dataset = DataSet(output, 'w', **options)
+        if len(input.provenance) > 0:
+            dataset.provenance = input.provenance
+
+        keys = input.keys()
+        # empty trajectories don't show up in iter_chunks, so they're
+        # written separately, in order
+        empty = collections.deque(key for key in keys if input.length(key) == 0)
+        with dataset.batch():
+            for key, offset, data in input.iter_chunks(self.chunk_size, prefetch=2):
+                while len(empty) > 0 and empty[0] < key:
+                    self._write_empty(input, dataset, empty.popleft())
+                dataset.append(key, data)
+            for key in empty:
+                self._write_empty(input, dataset, key)
+
+            for key in keys:
+                trajfn = input.get_trajfn(key)
+                if trajfn:
+                    dataset.set_trajfn(key, trajfn)
+            key_set = set(keys)
+            for filename, (key, mtime, size) in input.sources().iteritems():
+                if key in key_set:
+                    dataset.record_source(key, filename, mtime, size)
+        return dataset
+
+    def _write_empty(self, input, dataset, key):
+        dataset[key] = np.empty(input.shape(key), dtype=input.dtype(key))
+
+    def _read_throughput(self, dataset):
+        """Time a full pass through the dataset, in MB/s. An untimed pass
+        goes first, so that the input and output are both measured with a
+        warm page cache."""
+        for key, offset, data in dataset.iter_chunks(self.chunk_size):
+            pass
+        nbytes = 0
+        start = time.time()
+        for key, offset, data in dataset.iter_chunks(self.chunk_size):
+            nbytes += data.nbytes
+        return nbytes / 1e6 / max(time.time() - start, 1e-9)
@@ -1,3 +1,4 @@
+import collections
 import tables
 import numpy as np
 import mdtraj as md
@@ -8,7 +9,8 @@ from IPython.utils.traitlets import Unicode, Int, Enum, Instance, Bool
 from msmbuilder3.config.app import MSMBuilderApp
 from .vectorapp import VectorApp
 from msmbuilder3 import tICA
-from msmbuilder3 import DataSet
+from msmbuilder3 import DataSet, MemoryDataSet
+from msmbuilder3.base import float_dtype
 
 
 class TICAApp(MSMBuilderApp):
@@ -46,6 +48,19 @@ class TICAApp(MSMBuilderApp):
     lagtime = Int(1, config=True, help='''Lag time to use in calcualting the time
         lag correlation matrix. The units are in frames. This option is only in
         effect when `mode`==`fit` or `mode` == `fit_transform`.''')
+    chunk_size = Int(100000, config=True, help='''When `source`==`precomputed`,
+        the tICA model is fit by streaming through the dataset in blocks of
+        at most this many frames, so that memory usage does not grow with the
+        length of the trajectories.''')
+    prefetch = Int(2, config=True, help='''When `source`==`precomputed`, the
+        number of blocks of `chunk_size` frames to read and decompress ahead
+        on a background thread while the current block is being processed.
+        Use 0 to disable read-ahead.''')
+    cache_bytes = Int(2**30, config=True, help='''When `source`==`vector`, the
+        vectorized trajectories computed while fitting the model are kept
+        (in memory, up to this many bytes, and in a temporary file beyond
+        that) so that they don't have to be computed again to be projected
+        into the tIC space.''')
     classes = [VectorApp]
 
     vectorapp = Instance(VectorApp, config=False)
@@ -54,6 +69,7 @@ class TICAApp(MSMBuilderApp):
     tica = Instance(tICA, help='The compute engine', config=False)
     is_fit = Bool(False, help='Is the model currently fit?', config=False)
     input_provenance = None
+    _cache = None
     
     def start(self):
         self.fit()
@@ -69,10 +85,11 @@ class TICAApp(MSMBuilderApp):
             dataset = DataSet(self.output, mode='w', name='TICAApp')
             if self.source == 'precomputed':
                 dataset.provenance = self.input_provenance
-                
-            for i, (data, fn) in enumerate(self.yield_transform(with_filenames=True)):
-                 dataset[i] = data
-                 dataset.set_trajfn(i, fn)
+                self._transform_chunks(dataset)
+            else:
+                for i, (data, fn) in enumerate(self.yield_transform(with_filenames=True)):
+                     dataset[i] = data
+                     dataset.set_trajfn(i, fn)
             dataset.close()
         else:
             raise RuntimeError()
@@ -88,13 +105,19 @@ class TICAApp(MSMBuilderApp):
         else:
             self.tica = tICA(lag=self.lagtime, n_components=self.n_components)
             self.log.info('* Starting fitting of tICA model...')
-            for data in self._yield_input():
+            for data in self._yield_fit_input():
                 self.tica.fit_update(data)
             self.is_fit = True
             self.log.info('= Finished fitting of tICA model')
 
     def _yield_input(self, with_filenames=False):
-        if self.source == 'vector':
+        if self.source == 'vector' and self._cache is not None:
+            for key in self._cache.keys():
+                if with_filenames:
+                    yield self._cache[key], self._cache.get_trajfn(key)
+                else:
+                    yield self._cache[key]
+        elif self.source == 'vector':
             for data in self.vectorapp.yield_transform(with_filenames):
                 yield data
         else:
@@ -107,11 +130,67 @@ class TICAApp(MSMBuilderApp):
             self.input_provenance = dataset.provenance
             dataset.close()
 
+    def _yield_fit_input(self):
+        if self.source == 'vector' and self.mode == 'fit':
+            for data in self.vectorapp.yield_transform():
+                yield data
+        elif self.source == 'vector':
+            # hang on to the vectorized trajectories for the transform
+            cache = MemoryDataSet(self.cache_bytes)
+            for key, (data, fn) in enumerate(self.vectorapp.yield_transform(with_filenames=True)):
+                cache[key] = data
+                cache.set_trajfn(key, fn)
+                yield data
+            self._cache = cache
+        else:
+            dataset = DataSet(self.input)
+            for key, offset, data in dataset.iter_chunks(self.chunk_size, lag=self.lagtime,
+                                                         prefetch=self.prefetch):
+                yield data
+            self.input_provenance = dataset.provenance
+            dataset.close()
+
+    def _transform_chunks(self, dataset):
+        # stream the precomputed input through the tICA projection block by
+        # block, so that neither the input nor the output trajectories ever
+        # have to be held in memory in their entirety
+        self.log.info('*** Starting transformation of data into tIC space...')
+        input = DataSet(self.input)
+        # empty trajectories don't show up in iter_chunks, so they're
+        # written separately, in order
+        empty = collections.deque(key for key in input.keys() if input.length(key) == 0)
+        with dataset.batch():
+            for key, offset, data in input.iter_chunks(self.chunk_size, prefetch=self.prefetch):
+                while len(empty) > 0 and empty[0] < key:
+                    self._write_empty(input, dataset, empty.popleft())
+                dataset.append(key, self.tica.transform(data))
+                if offset == 0:
+                    dataset.set_trajfn(key, input.get_trajfn(key))
+            for key in empty:
+                self._write_empty(input, dataset, key)
+        input.close()
+        self.log.info('=== Finished transformation of data into tIC space')
+
+    def _write_empty(self, input, dataset, key):
+        dataset[key] = np.empty((0, self.tica.n_components), dtype=float_dtype())
+        dataset.set_trajfn(key, input.get_trajfn(key))
+
     def yield_transform(self, with_filenames=False):
         self.log.info('*** Starting transformation of data into tIC space...')
-        for row in self._yield_input(with_filenames):
-            if with_filenames:
-                yield self.tica.transform(row[0]), row[1]
-            else:
-                yield self.tica.transform(row)
+        try:
+            for row in self._yield_input(with_filenames):
+                if with_filenames:
+                    yield self.tica.transform(row[0]), row[1]
+                else:
+                    yield self.tica.transform(row)
+        finally:
+            # the cached input is only read once
+            self.close()
         self.log.info('=== Finished transformation of data into tIC space')
+
+    def close(self):
+        """Drop the cache of vectorized trajectories kept from the fit, and
+        delete its temporary file, if any"""
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
@@ -1,15 +1,16 @@
 import os
 import sys
+import multiprocessing
 import numpy as np
 import mdtraj as md
 import tables
-from IPython.utils.traitlets import Unicode, Int, Enum, Instance
+from IPython.utils.traitlets import Unicode, Int, Enum, Instance, Bool
 
 from msmbuilder3.config.app import MSMBuilderApp
 from msmbuilder3.base import TransformerMixin
 from msmbuilder3 import (PositionVectorizer, DistanceVectorizer,
                          AngleVectorizer, DihedralVectorizer)
-from msmbuilder3 import DataSet
+from msmbuilder3 import DataSet, LiveDataSet, DataSetWriter
 
 class VectorApp(MSMBuilderApp):
     name = 'vector'
@@ -26,36 +27,182 @@ class VectorApp(MSMBuilderApp):
                        'dihedral'], supply a path to a file containing the indices of the atoms
                        to use for defining the pairs / triplets / quartets of atoms. This file
                        should contain a two-dimensional array of integers.''')
+    append = Bool(False, config=True, help='''Add to an existing output DataSet
+                  instead of overwriting it. Only the trajectory files in `input`
+                  that are new, or that have been modified since they were last
+                  vectorized into the DataSet, are processed.''')
+    live = Bool(False, config=True, help='''Write the output as a live dataset:
+                a directory of segment files and a log, which other programs
+                (like `msmb info`) can read while it is still being written.
+                Finished trajectories are published periodically.''')
+    chunk_size = Int(10000, config=True, help='''Read each trajectory file in
+                      blocks of at most this many frames, and write each block
+                      to the output as soon as it has been vectorized, so that
+                      memory usage is bounded by the size of a block rather
+                      than by the length of the longest trajectory. Use 0 to
+                      load each trajectory file whole.''')
+    stride = Int(1, config=True, help='''Only load every `stride`-th frame
+                  of each trajectory. Note that lag times in later steps are
+                  then measured in units of strided frames.''')
+    n_jobs = Int(1, config=True, help='''Vectorize this many trajectory files
+                  at once, in separate processes. The largest files (as a
+                  cheap proxy for the longest trajectories) are started
+                  first, and the results are all written by a single
+                  writer process. Use -1 for one process per CPU.''')
 
     vectorizer = Instance(TransformerMixin, config=False)
     def _vectorizer_default(self):
         indices = self._load_indices()
         methodmap = {'distance': DistanceVectorizer, 'angle': AngleVectorizer, 'dihedral': DihedralVectorizer}
         if self.method in methodmap:
-            return methodmap[self.method](indices)
+            # only the atoms in `indices` are loaded from the trajectory
+            # files, so renumber them by their position in that subset
+            self._atom_indices = np.unique(indices)
+            return methodmap[self.method](np.searchsorted(self._atom_indices, indices))
 
         raise NotImplementedError()
 
+    # The atoms to load from each trajectory file, or None for all of them
+    _atom_indices = None
+
     def start(self):
+        if self.live:
+            if self.append:
+                self.error('live and append cannot be used together')
+            if self.n_jobs != 1:
+                self.error('live and n_jobs cannot be used together')
+            self.log.info('Writing LiveDataSet: %s' % self.output)
+            dataset = LiveDataSet(self.output, 'w', name='VectorApp-%s' % self.method)
+            for key, file in enumerate(self._input_filenames()):
+                self._write_transform(dataset, key, file)
+                dataset.set_trajfn(key, file)
+            dataset.close()
+            return
+
         self.log.info('Writing DataSet: %s' % self.output)
-        dataset = DataSet(self.output, mode='w', name='VectorApp-%s' % self.method)
-        for i, (data, file) in enumerate(self.yield_transform(with_filenames=True)):
-            dataset[i] = data
-            dataset.set_trajfn(i, file)
+        if self.n_jobs != 1:
+            # the writer process creates (or opens) the file itself, so the
+            # existing dataset, if any, is only read here
+            dataset = None
+            if self.append and os.path.exists(self.output):
+                dataset = DataSet(self.output)
+            file_keys, filenames = self._assign_keys(dataset)
+            if dataset is not None:
+                dataset.close()
+            self._parallel_transform(file_keys, filenames)
+            return
+
+        dataset = DataSet(self.output, mode='a' if self.append else 'w',
+                          name='VectorApp-%s' % self.method)
+        file_keys, filenames = self._assign_keys(dataset)
+        for key, file in zip(file_keys, filenames):
+            self._write_transform(dataset, key, file, pending_source=True)
+            dataset.set_trajfn(key, file)
+            dataset.record_source(key, file)
         dataset.close()
 
-    def yield_transform(self, with_filenames=False):
+    def _assign_keys(self, dataset):
+        """Figure out which key of `dataset` (None for a new, empty dataset)
+        each input file should be written to. Files that were vectorized
+        before and haven't changed are skipped, and files that were
+        vectorized before but have since changed keep their old key.
+
+        Returns
+        -------
+        file_keys : list of ints
+        filenames : list of str
+        """
+        keys = dataset.keys() if dataset is not None else []
+        next_key = keys[-1] + 1 if len(keys) > 0 else 0
+        sources = dataset.sources() if dataset is not None else {}
+        filenames, file_keys = [], []
+        for fn in self._input_filenames():
+            if dataset is not None and dataset.is_processed(fn):
+                continue
+            filenames.append(fn)
+            if fn in sources:
+                file_keys.append(sources[fn][0])
+            else:
+                file_keys.append(next_key)
+                next_key += 1
+        if self.append:
+            self.log.info('%d new or modified trajectories to vectorize' % len(filenames))
+        return file_keys, filenames
+
+    def yield_transform(self, with_filenames=False, filenames=None):
+        if filenames is None:
+            filenames = self._input_filenames()
+
+        for file in filenames:
+            t = md.load(file, **self._load_kwargs())
+            r = self.vectorizer.transform(t)
+            if with_filenames:
+                yield r, file
+            else:
+                yield r
+
+    def yield_transform_chunks(self, filename):
+        """Vectorize the trajectory file `filename`, yielding the result in
+        blocks of at most `chunk_size` frames"""
+        for t in _iterload(filename, self.chunk_size, self._load_kwargs()):
+            yield self.vectorizer.transform(t)
+
+    def _parallel_transform(self, file_keys, filenames):
+        """Vectorize `filenames` into the trajectories `file_keys` of the
+        output DataSet with a pool of `n_jobs` processes, largest file first"""
+        n_jobs = self.n_jobs if self.n_jobs > 0 else multiprocessing.cpu_count()
+        jobs = sorted(zip(file_keys, filenames), key=lambda job: _job_size(job[1]),
+                      reverse=True)
+        self.log.info('Vectorizing %d trajectories with %d processes' % (len(jobs), n_jobs))
+
+        writer = DataSetWriter(self.output, mode='a' if self.append else 'w',
+                               name='VectorApp-%s' % self.method)
+        pool = multiprocessing.Pool(n_jobs, initializer=_init_worker,
+                                    initargs=(writer, self.vectorizer, self.chunk_size,
+                                              self._load_kwargs()))
+        try:
+            # chunksize=1, so that the jobs are handed out in order
+            for key, file in pool.imap_unordered(_vectorize_file, jobs, chunksize=1):
+                self.log.debug('Vectorized %s' % file)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            writer.close()
+
+    def _load_kwargs(self):
+        """The keyword arguments for loading a trajectory file: only the
+        atoms that the vectorizer needs, and only every `stride`-th frame"""
+        if self.stride < 1:
+            self.error('stride must be a positive integer')
+        # make sure the vectorizer, and so the atom subset, has been built
+        self.vectorizer
+        return {'atom_indices': self._atom_indices, 'stride': self.stride}
+
+    def _write_transform(self, dataset, key, filename, pending_source=False):
+        """Vectorize the trajectory file `filename` into the `key`-th
+        trajectory of `dataset`, one block at a time. With pending_source,
+        the file is recorded as a pending source of the trajectory as soon
+        as it is started (see `_pending_source`)."""
+        for i, data in enumerate(self.yield_transform_chunks(filename)):
+            if i == 0:
+                # replace whatever was stored under this key before
+                dataset[key] = data
+                if pending_source:
+                    dataset.record_source(key, *_pending_source(filename))
+            else:
+                dataset.append(key, data)
+
+    def _input_filenames(self):
+        """The absolute paths of the trajectory files in `input`, sorted"""
         if not os.path.exists(self.input):
             self.error('No such file or directory: %s' % self.input)
 
         if os.path.isdir(self.input):
-            for file in os.listdir(self.input):
-                t = md.load(os.path.join(self.input, file))
-                r = self.vectorizer.transform(t)
-                if with_filenames:
-                    yield r, os.path.abspath(file)
-                else:
-                    yield r
+            return [os.path.abspath(os.path.join(self.input, fn))
+                    for fn in sorted(os.listdir(self.input))]
         else:
             raise NotImplementedError()
 
@@ -86,3 +233,60 @@ class VectorApp(MSMBuilderApp):
                            'four columns. You supplied an array of shape %s '
                            % (self.indices, indices.shape))
         return indices
+
+
+def _iterload(filename, chunk_size, load_kwargs):
+    """Load a trajectory file in blocks of at most `chunk_size` frames, or
+    whole if `chunk_size` is 0"""
+    if chunk_size > 0:
+        for t in md.iterload(filename, chunk=chunk_size, **load_kwargs):
+            yield t
+    else:
+        yield md.load(filename, **load_kwargs)
+
+
+def _pending_source(filename):
+    """The arguments of `DataSet.record_source` that mark `filename` as the
+    source of a trajectory that is still being written. The impossible
+    size means it is never considered processed, so if the run dies before
+    the whole file is written, the next run (with append) vectorizes it
+    again into the same key, replacing the partial trajectory."""
+    return filename, -1.0, -1
+
+
+def _job_size(filename):
+    """The size of a trajectory file in bytes, as a proxy for its number of
+    frames when scheduling. Counting the frames would mean reading every
+    file in the parent process (for formats without an index, like XTC
+    or DCD), which can cost as much as the parallel work saves."""
+    return os.path.getsize(filename)
+
+
+# The state of a worker process of VectorApp._parallel_transform
+_worker = {}
+
+def _init_worker(writer, vectorizer, chunk_size, load_kwargs):
+    _worker.update(writer=writer, vectorizer=vectorizer, chunk_size=chunk_size,
+                   load_kwargs=load_kwargs)
+
+
+def _vectorize_file(job):
+    """Vectorize one trajectory file, in a worker process, and send it to
+    the writer one block at a time"""
+    key, filename = job
+    writer, vectorizer = _worker['writer'], _worker['vectorizer']
+
+    # each block is sent once the next one has been vectorized, so that the
+    # last block can carry the trajfn and source. the file is only recorded
+    # as processed once all of it has been written; until then, it's
+    # recorded as a pending source
+    block, n_blocks = None, 0
+    for t in _iterload(filename, _worker['chunk_size'], _worker['load_kwargs']):
+        if block is not None:
+            writer.put(key, block, append=n_blocks > 1,
+                       source=_pending_source(filename) if n_blocks == 1 else None)
+        block = vectorizer.transform(t)
+        n_blocks += 1
+    if block is not None:
+        writer.put(key, block, trajfn=filename, source=filename, append=n_blocks > 1)
+    return key, filename
@@ -8,6 +8,11 @@ import time
 import getpass
 import warnings
 import datetime
+import functools
+import tempfile
+import threading
+import contextlib
+import collections
 
 import tables
 import numpy as np
@@ -18,6 +23,23 @@ try:
 except ImportError:
     pass
 
+# Maximum number of dimensions of a single frame that the index can record
+_MAX_FRAME_NDIM = 8
+# The HDF5 library is generally not built to be thread-safe, so every call
+# that DataSet makes into PyTables (on any thread, including the prefetching
+# threads of iter_chunks) holds this lock
+_hdf5_lock = threading.RLock()
+
+
+def _with_hdf5_lock(f):
+    "Decorator for methods that call into PyTables, to hold `_hdf5_lock`"
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        with _hdf5_lock:
+            return f(*args, **kwargs)
+    return wrapper
+
+
 class UnrecognizedFormatError(IOError):
     pass
 
@@ -33,25 +55,121 @@ class DataSet(object):
     ----------
     filename : str
         The filename to open
-    mode : {'r', 'w'}
-        Open the file to read ('r'), or write ('w')
+    mode : {'r', 'w', 'a'}
+        Open the file to read ('r'), write ('w'), or append ('a'). In
+        mode == 'a', new trajectories can be added to (and existing ones
+        replaced in) an existing dataset. If the file does not exist, mode
+        'a' behaves like 'w'.
     timestep : int
         In mode == 'w',
     name : str
         In mode == 'w'
     force_overwrite : bool
-    compression : {'blosc', 'zlib', None}
+    compression : {'blosc', 'blosc:lz4', 'blosc:zstd', 'blosc:blosclz', 'zlib', None}, or tables.Filters
+        The compression library used to store the trajectories in mode
+        'w'. 'blosc' uses blosc's default (blosclz) codec, and 'blosc:<codec>'
+        picks one of the other codecs bundled with blosc (see
+        `tables.blosc_compressor_list()`). A `tables.Filters` instance is
+        used as is, and `complevel` and `shuffle` are ignored.
+        `tune_compression` can help pick between them.
+    complevel : int, optional
+        The compression level, from 1 (fastest) to 9 (smallest). The default
+        is 9 for blosc and 1 for zlib.
+    shuffle : {'byte', 'bit', None}
+        Rearrange the bytes ('byte') or bits ('bit') of each block of
+        values before compressing them, which usually helps a lot with
+        numerical data. Bit shuffling is only available with blosc.
+    chunkshape : int or tuple, optional
+        The shape of the HDF5 chunks in which each trajectory is stored. If
+        an int, it gives the number of frames per chunk. If None, PyTables
+        will pick a chunkshape based on the length of the first block of
+        frames written to each trajectory.
+    mmap : bool
+        In mode == 'r', return read-only `np.memmap` views of each
+        trajectory instead of copying the data out of the HDF5 file. Only
+        uncompressed datasets (compression=None) can be memory-mapped. The
+        raw data is served from a sidecar file, `filename + '.mmap'`, which
+        is (re)built on the first open after the dataset changes, and is
+        shared through the page cache by every process that maps it.
+    layout : {'nodes', 'flat'}
+        In mode == 'w', how the trajectories are laid out in the file. With
+        'nodes', each trajectory is stored in its own HDF5 array. With 'flat',
+        all of the frames are stored in a single 2-D (or higher) array, one
+        trajectory after another, and trajectory `keys()[i]` occupies rows
+        `offsets()[i]:offsets()[i+1]`. The flat layout scales much better to
+        large numbers of short trajectories, and `flat()` can return the
+        whole dataset without concatenating anything. In exchange, new
+        trajectories must be added in order of increasing key, frames can only
+        be appended to the last trajectory, and every trajectory must share
+        the same frame shape and dtype.
+    encoding : {None, 'narrow', 'rle'}
+        In mode == 'w', how trajectories of integers (like state assignments)
+        are encoded. With 'narrow', they are stored with the smallest integer
+        dtype (unsigned, if there are no negative values) that can hold every
+        value. With 'rle', one dimensional integer trajectories are
+        additionally run-length encoded, which is usually far more compact
+        for state assignments, since trajectories dwell in each state for
+        many frames. Either way, the data is decoded transparently (and
+        returned with its original dtype) on read. Only available with the
+        'nodes' layout.
+    pyramid : sequence of ints
+        In mode == 'w', also store strided copies of every trajectory,
+        holding every `k`-th frame for each `k` in `pyramid` (for example,
+        (10, 100)). Reads with a step that is a multiple of one of these
+        strides (like `dataset[i, ::100]`, or `iter_chunks(stride=100)`)
+        are then served from the coarsest suitable copy, rather than
+        decompressing every chunk of the full trajectory.
+    column_block : int, optional
+        Store trajectories with more than one dimension in chunks that span
+        only `column_block` features (columns) each, instead of whole
+        frames, so that reading a few of many features with
+        `read_columns` or `iter_chunks(columns=...)` only has to read and
+        decompress the chunks holding those features. If `chunkshape` is an
+        int, it gives the number of frames per chunk; otherwise the chunks
+        hold about 256 KB each. Ignored if `chunkshape` is a tuple.
+    stats : bool
+        Keep the per-feature summary statistics (see `stats`) up to date
+        as trajectories are written. With stats=False, nothing is
+        accumulated or recomputed, which saves work for temporary files
+        that are never summarized, and any statistics stored earlier are
+        discarded if the dataset is modified.
     
     Attributes
     ----------
     provenance : pd.DataFrame
         A dataframe or (record array if you don't have pandas installed)
         containing the provenance information for this DataSet
+    stats : dict
+        Per-feature summary statistics (count, mean, var, min and max) over
+        every frame in the dataset. These are accumulated as the data is
+        written, so reading them is free.
+
+    Notes
+    -----
+    The length, shape and dtype of every trajectory are recorded in the
+    `index` table when the trajectory is written, and loaded into memory
+    once when the dataset is opened, so `keys()`, `length()`, `shape()`
+    and `dtype()` never need to touch the trajectory data itself.
     """
 
     trajectory_table = {
         'filename': tables.StringCol(1024),
         'nodename': tables.StringCol(1024),
+        'key': tables.Int64Col(),
+        'length': tables.Int64Col(),
+        'ndim': tables.Int32Col(),
+        'frame_shape': tables.Int64Col(shape=(_MAX_FRAME_NDIM,)),
+        'dtype': tables.StringCol(32),
+    }
+    # In-memory copy of the metadata columns of the index table
+    _entry_dtype = np.dtype([('key', np.int64), ('length', np.int64), ('ndim', np.int32),
+                             ('frame_shape', np.int64, (_MAX_FRAME_NDIM,)), ('dtype', 'S32')])
+
+    source_table = {
+        'filename': tables.StringCol(1024),
+        'key': tables.Int64Col(),
+        'mtime': tables.Float64Col(),
+        'size': tables.Int64Col(),
     }
 
     provenance_table = {
@@ -62,53 +180,103 @@ class DataSet(object):
         'executable': tables.StringCol(1024)
     }
 
+    # Versions of the file format that we know how to read
+    _format_versions = ['1.0', '1.1', '1.2', '1.3']
+
     # List of opened datasets
     _open_datasets = []
+    # Byte alignment of each trajectory in the mmap sidecar file
+    _mmap_alignment = 64
+    # Largest gap (in frames) between requested frames that `take` will read
+    # straight through, rather than issuing a separate read
+    _gather_max_gap = 64
+    # Target size of each chunk, in bytes, with a column-blocked layout
+    _column_chunk_bytes = 2**18
 
-    def __init__(self, filename, mode='r', timestep=1, name='dataset', force_overwrite=True, compression='blosc'):
+    @_with_hdf5_lock
+    def __init__(self, filename, mode='r', timestep=1, name='dataset', force_overwrite=True, compression='blosc',
+                 chunkshape=None, mmap=False, layout='nodes', complevel=None, shuffle='byte',
+                 encoding=None, pyramid=(), column_block=None, stats=True):
         self._open = False
+        self._track_stats = stats
         self.mode = mode
+        self.chunkshape = chunkshape
+        self._mmap_arrays = None
+        self._mmap_flat = None
+        self._batch_depth = 0
+        self._dirty_rows = set()
+        self._pending_filenames = {}
 
-        if not mode in ['r', 'w']:
-            raise ValueError("mode must be one of ['r', 'w']")
+        if not mode in ['r', 'w', 'a']:
+            raise ValueError("mode must be one of ['r', 'w', 'a']")
+        if mmap and mode != 'r':
+            raise ValueError("mmap is only available in mode='r'")
+        if not layout in ['nodes', 'flat']:
+            raise ValueError("layout must be one of ['nodes', 'flat']")
+        if not encoding in [None, 'narrow', 'rle']:
+            raise ValueError("encoding must be one of [None, 'narrow', 'rle']")
+        if encoding is not None and layout != 'nodes':
+            raise ValueError("encoding is only available with layout='nodes'")
+        if column_block is not None and column_block < 1:
+            raise ValueError('column_block must be positive')
+        if any(int(k) != k or k < 2 for k in pyramid):
+            raise ValueError('the pyramid strides must be integers greater than 1')
         if mode == 'w' and not force_overwrite and os.path.exists(filename):
             raise IOError('"%s" already exists' % filename)
 
-        if compression == 'blosc':
-            compression = tables.Filters(complib='blosc', shuffle=True, complevel=9)
-        elif compression == 'zlib':
-            compression = tables.Filters(complib='zlib', shuffle=True, complevel=1)
-        elif compression is None:
-            compression = None
-        else:
-            raise ValueError("compression must be either 'zlib', 'blosc', or None")
-
+        compression = _make_filters(compression, complevel, shuffle)
+        new_file = mode == 'w' or (mode == 'a' and not os.path.exists(filename))
         self._handle = tables.open_file(filename, mode=mode, filters=compression)
         self._open = True
+        self._appended_provenance = False
 
-        if self.mode == 'w':
+        if new_file:
             self._index = tables.Table(self._handle.root, 'index', self.trajectory_table, title='Index of the data group')
             self._provenance = tables.Table(self._handle.root, 'provenance', self.provenance_table, title='provenance')
             self._data = tables.Group(self._handle.root, 'data', new=True)
             self.timestep = timestep
             self.name = name
-            self._appended_provenance = False
             self._handle.root._v_attrs.format = 'msmbuilder-dataset'
-            self._handle.root._v_attrs.format_version = '1.0'
+            self._handle.root._v_attrs.format_version = self._format_versions[-1]
+            self._handle.root._v_attrs.layout = layout
+            if encoding is not None:
+                self._handle.root._v_attrs.encoding = encoding
+            if len(pyramid) > 0:
+                pyramid_group = tables.Group(self._handle.root, 'pyramid', new=True)
+                for k in sorted(set(pyramid)):
+                    tables.Group(pyramid_group, 's%d' % k, new=True)
+                self._handle.root._v_attrs.pyramid = sorted(set(int(k) for k in pyramid))
+            if column_block is not None:
+                self._handle.root._v_attrs.column_block = int(column_block)
         else:
             if not hasattr(self._handle.root._v_attrs, 'format') or \
                     self._handle.root._v_attrs.format != 'msmbuilder-dataset':
                 raise UnrecognizedFormatError('%s is not an msmbuilder dataset' % filename)
             if not hasattr(self._handle.root._v_attrs, 'format_version') or \
-                    self._handle.root._v_attrs.format_version != '1.0':
-                raise UnrecognizedFormatError('only msmbuilder-dataset version 1.0 is supported')
+                    self._handle.root._v_attrs.format_version not in self._format_versions:
+                raise UnrecognizedFormatError('only msmbuilder-dataset versions %s are supported'
+                                              % ', '.join(self._format_versions))
+            if mode == 'a' and self._handle.root._v_attrs.format_version == '1.0':
+                raise UnrecognizedFormatError('msmbuilder-dataset version 1.0 files cannot '
+                                              'be opened in mode="a"')
             self._index = self._handle.root.index
             self._provenance = self._handle.root.provenance
             self._data = self._handle.root.data
 
+        self.layout = getattr(self._handle.root._v_attrs, 'layout', 'nodes')
+        self.encoding = getattr(self._handle.root._v_attrs, 'encoding', None)
+        self.pyramid = list(getattr(self._handle.root._v_attrs, 'pyramid', []))
+        self.column_block = getattr(self._handle.root._v_attrs, 'column_block', None)
+        self._flat = getattr(self._data, 'frames', None) if self.layout == 'flat' else None
+        self._load_index()
+        self._load_sources()
+        self._load_stats()
         self._open_datasets.append(self)
+        if mmap:
+            self._mmap_arrays = self._load_mmap(filename)
 
     @property
+    @_with_hdf5_lock
     def name(self):
         "Get the name of this dataset"
         if hasattr(self._handle.root._v_attrs, 'name'):
@@ -116,26 +284,31 @@ class DataSet(object):
         return None
 
     @name.setter
-    @ensure_mode('w')
+    @ensure_mode('w', 'a')
+    @_with_hdf5_lock
     def name(self, value):
-        "Set the name of this dataset. Only available when mode='w'"
+        "Set the name of this dataset. Only available when mode='w' or 'a'"
         self._handle.root._v_attrs.name = value
 
     @property
+    @_with_hdf5_lock
     def timestep(self):
         return self._handle.root._v_attrs.timestep
 
     @timestep.setter
+    @_with_hdf5_lock
     def timestep(self, value):
         self._handle.root._v_attrs.timestep = value
 
     @property
+    @_with_hdf5_lock
     def provenance(self):
         if 'pandas' in sys.modules:
             return pd.DataFrame.from_records(self._provenance[:])
         return self._provenance[:]
     
     @provenance.setter
+    @_with_hdf5_lock
     def provenance(self, value):
         """Set the provenance table for this dataset
         """
@@ -155,32 +328,30 @@ class DataSet(object):
 
         self._provenance.append(records)
 
-    @ensure_mode('w')
+    @ensure_mode('w', 'a')
     def __setitem__(self, key, value):
         "Set data on  the `key`-th trajectory on the dataset."
-        if not np.isscalar(key) or key != int(key):
-            raise TypeError('key must be an int. You supplied %s of type %s'
-                            % (key, type(key)))
-        if not isinstance(value, np.ndarray):
-            raise TypeError('value must be a numpy array. You supplied %s of '
-                            'type %s' % (value, type(value)))
+        self._write(key, value, append=False)
 
-        try:
-            array = self._handle.get_node(self._data, name=self._node_name(key))
-            array[:] = value
-            new_array = False
-        except tables.NoSuchNodeError:
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore", category=tables.NaturalNameWarning)
-                array = self._handle.create_array(self._data, name=self._node_name(key), obj=value)
-            new_array = True
-            self._index.row['nodename'] = self._node_name(key)
-            self._index.row.append()
-            self._index.flush()
+    @ensure_mode('w', 'a')
+    def append(self, key, value):
+        """Append frames to the end of the `key`-th trajectory in the dataset.
 
-        array.flush()
-        self._handle.flush()
+        If the trajectory does not exist yet, it is created. This makes it
+        possible to write a trajectory to disk in blocks of frames, without
+        ever holding the whole thing in memory.
+
+        Parameters
+        ----------
+        key : int
+            The index of the trajectory
+        value : np.ndarray
+            The block of frames to append. All but the first dimension of
+            `value` must match the shape of the frames already stored.
+        """
+        self._write(key, value, append=True)
 
+    @_with_hdf5_lock
     def __getitem__(self, key):
         if isinstance(key, tuple):
             trj_index = key[0]
@@ -193,55 +364,968 @@ class DataSet(object):
         else:
             raise IndexError('index must be either an int or a sequence')
 
-        try:
-            return self._handle.get_node(self._data, self._node_name(trj_index))[frame_index]
-        except tables.NoSuchNodeError:
-            raise KeyError(key)
-    
+        first = frame_index[0] if isinstance(frame_index, tuple) and len(frame_index) > 0 else frame_index
+        if isinstance(first, slice) and first.step is not None and first.step > 1:
+            start, stop, step = first.indices(self.length(trj_index))
+            array, k = self._pyramid_level(trj_index, step, start)
+            if k > 1:
+                # frame k*j of the trajectory is frame j of this level
+                first = slice(start // k, -(-stop // k), step // k)
+                rest = frame_index[1:] if isinstance(frame_index, tuple) else ()
+                return array[(first,) + rest]
+
+        return self._get_array(trj_index)[frame_index]
+
     def keys(self):
-        return [self._key_name(e.name) for e in self._handle.iter_nodes(self._data)]
+        "Get the (sorted) list of the keys of the trajectories in the dataset"
+        return self._entries['key'][self._sorted_rows()].tolist()
+
+    def iter_chunks(self, chunk_size=10000, stride=1, lag=0, keys=None,
+                    columns=None, prefetch=0, prefetch_bytes=None):
+        """Iterate over the dataset in blocks of at most `chunk_size` frames
+
+        Only one block is read into memory at a time, so this can be used
+        to stream through datasets that are much larger than RAM.
 
-    @ensure_mode('w')
+        Parameters
+        ----------
+        chunk_size : int
+            The number of (strided) frames in each block.
+        stride : int
+            Only read every `stride`-th frame from each trajectory.
+        lag : int
+            Each block is extended with the `lag` (strided) frames that
+            follow it in the same trajectory, so that consecutive blocks
+            overlap by `lag` frames. Feeding the blocks to an estimator that
+            uses time-lagged pairs of frames (like tICA with the same `lag`)
+            then visits every pair within a trajectory exactly once.
+        keys : list of ints, optional
+            The trajectories to iterate over. By default, all of them.
+        columns : list of ints, optional
+            Only read these features (indices along the second axis), as
+            with `read_columns`. By default, all of them.
+        prefetch : int
+            If positive, read (and decompress) up to this many blocks ahead
+            on a background thread, so that the I/O overlaps with whatever
+            the caller is doing with the current block.
+        prefetch_bytes : int, optional
+            Stop reading ahead once the blocks waiting in the queue take up
+            at least this many bytes. Only used with prefetch > 0.
+
+        Yields
+        ------
+        key : int
+            The index of the trajectory that the block comes from
+        offset : int
+            The (unstrided) index in the trajectory of the first frame in
+            the block
+        data : np.ndarray
+            The block of frames, `dataset[key, offset:offset+len(data)*stride:stride]`
+
+        Notes
+        -----
+        With prefetch > 0, the HDF5 library is called from a background
+        thread. Every DataSet method that touches a file (on any thread)
+        is serialized with these reads, but other direct uses of PyTables
+        while the iterator is running are not.
+        """
+        if chunk_size < 1 or stride < 1 or lag < 0:
+            raise ValueError('chunk_size and stride must be positive, and lag '
+                             'must be non-negative')
+        if keys is None:
+            keys = self.keys()
+
+        blocks = self._iter_chunks(chunk_size, stride, lag, keys, columns)
+        if prefetch > 0:
+            return _prefetch(blocks, prefetch, prefetch_bytes)
+        return blocks
+
+    def _iter_chunks(self, chunk_size, stride, lag, keys, columns):
+        for key in keys:
+            with _hdf5_lock:
+                array, k = self._pyramid_level(key, stride)
+                step = stride // k
+                n_frames = len(xrange(0, len(array), step))
+            # with lag > 0, blocks with no more than lag frames contain
+            # no time-lagged pairs, so we don't bother yielding them
+            for start in xrange(0, n_frames - lag, chunk_size):
+                stop = min(start + chunk_size + lag, n_frames)
+                # the lock is not held while the block is being used
+                with _hdf5_lock:
+                    if columns is None:
+                        data = array[start*step:stop*step:step]
+                    else:
+                        data = _read_columns(array, columns, slice(start*step, stop*step, step))
+                yield key, start*stride, data
+
+    def read_columns(self, key, columns, start=None, stop=None, step=None):
+        """Read a subset of the features of one trajectory
+
+        Parameters
+        ----------
+        key : int
+            The index of the trajectory
+        columns : list of ints
+            The indices of the features to read, along the second axis of the
+            trajectory, in any order.
+        start, stop, step : int, optional
+            Only read the frames `start:stop:step`.
+
+        Returns
+        -------
+        data : np.ndarray, shape=[n_frames, len(columns), ...]
+            `dataset[key, start:stop:step][:, columns]`, but only the
+            requested features are read from disk, which (with a
+            `column_block` layout) saves most of the I/O when few of many
+            features are requested.
+        """
+        with _hdf5_lock:
+            return self._read_column_frames(key, columns, start, stop, step)
+
+    def _read_column_frames(self, key, columns, start, stop, step):
+        frames = slice(start, stop, step)
+        if step is not None and step > 1:
+            start, stop, step = frames.indices(self.length(key))
+            array, k = self._pyramid_level(key, step, start)
+            if k > 1:
+                return _read_columns(array, columns, slice(start // k, -(-stop // k), step // k))
+        return _read_columns(self._get_array(key), columns, frames)
+
+    def iter_runs(self, keys=None):
+        """Iterate over the runs of repeated values in one dimensional
+        trajectories, like state assignments
+
+        With encoding='rle', the runs are read straight from the file
+        without decoding the trajectories. Otherwise, they are computed from
+        the trajectory data.
+
+        Parameters
+        ----------
+        keys : list of ints, optional
+            The trajectories to iterate over. By default, all of them.
+
+        Yields
+        ------
+        key : int
+            The index of the trajectory
+        values : np.ndarray, shape=[n_runs]
+            The value of each run, in order
+        lengths : np.ndarray, shape=[n_runs]
+            The number of frames in each run, so that
+            `np.repeat(values, lengths)` is the trajectory.
+        """
+        if keys is None:
+            keys = self.keys()
+
+        for key in keys:
+            with _hdf5_lock:
+                array = self._get_array(key)
+                if isinstance(array, _RunLengthArray):
+                    starts, values = array.runs()
+                else:
+                    if len(array.shape) != 1:
+                        raise ValueError('runs are only defined for one dimensional '
+                                         'trajectories')
+                    data = array[:]
+                    starts = _run_starts(data)
+                    values = data[starts]
+                length = len(array)
+            yield key, values, np.diff(np.append(starts, length))
+
+    @ensure_mode('w', 'a')
     def set_trajfn(self, key, value):
-        if int(key) == key:
-            trj_index = key
-        else:
-            raise IndexError('index must be either an int or a sequence')
-        self._index.cols.filename[key] = value
+        self._pending_filenames[self._row(key)] = value
+        self._flush()
         
+    @_with_hdf5_lock
     def get_trajfn(self, key):
-        if int(key) == key:
-            trj_index = key
+        row = self._row(key)
+        if row in self._pending_filenames:
+            return self._pending_filenames[row]
+        if row >= self._index.nrows:
+            # appended to the index inside a batch, but not yet committed
+            return ''
+        return self._index.cols.filename[row]
+
+    @ensure_mode('w', 'a')
+    @_with_hdf5_lock
+    def record_source(self, key, filename, mtime=None, size=None):
+        """Record that the `key`-th trajectory was computed from the file
+        `filename`, along with the file's current modification time and size.
+
+        Together with `is_processed`, this lets a dataset opened in mode='a'
+        be brought up to date by processing only new or modified files.
+
+        If `mtime` and `size` are given (as when copying the sources of
+        another dataset), they are recorded instead, and the file itself is
+        not examined.
+        """
+        row = self._row(key)
+        filename = os.path.abspath(filename)
+        if mtime is None or size is None:
+            stat = os.stat(filename)
+            mtime, size = stat.st_mtime, stat.st_size
+        self._sources[filename] = (key, mtime, size)
+
+        if self._source_table is None:
+            self._source_table = tables.Table(self._handle.root, 'sources', self.source_table,
+                                              title='Source files of the trajectories')
+        if filename in self._source_rows:
+            source_row = self._source_rows[filename]
+            self._source_table.flush()
+            self._source_table.cols.key[source_row] = key
+            self._source_table.cols.mtime[source_row] = mtime
+            self._source_table.cols.size[source_row] = size
         else:
-            raise IndexError('index must be either an int or a sequence')
-        return self._index[key]['filename']
+            self._source_rows[filename] = len(self._source_rows)
+            self._source_table.row['filename'] = filename
+            self._source_table.row['key'] = key
+            self._source_table.row['mtime'] = mtime
+            self._source_table.row['size'] = size
+            self._source_table.row.append()
+        self._flush()
+
+    def sources(self):
+        """Get the source files that have been recorded with `record_source`
+
+        Returns
+        -------
+        sources : dict
+            Maps the absolute path of each source file to a tuple of
+            (key, mtime, size), recorded when it was processed.
+        """
+        return dict(self._sources)
+
+    def is_processed(self, filename):
+        """Check whether `filename` has been recorded as the source of a
+        trajectory in this dataset, and has not changed since then."""
+        filename = os.path.abspath(filename)
+        if filename not in self._sources:
+            return False
+        key, mtime, size = self._sources[filename]
+        stat = os.stat(filename)
+        return key in self._rows and (mtime, size) == (stat.st_mtime, stat.st_size)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Context manager that defers flushing data and index updates to
+        disk until the end of the block.
+
+        Ordinarily, every write to the dataset is followed by flushing the
+        index and the whole file, which dominates the cost of writing many
+        small trajectories. Inside a batch, the index updates are kept in
+        memory and everything is committed at once when the (outermost)
+        batch exits -- even if it exits with an exception -- or when the
+        dataset is closed.
+
+        Examples
+        --------
+        >>> with dataset.batch():
+        ...     for i, x in enumerate(many_small_arrays):
+        ...         dataset[i] = x
+        """
+        if self.mode not in ['w', 'a']:
+            raise ValueError('batch() is only available in mode="w" or "a"')
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            self._flush()
 
     def length(self, key):
         """Get the length of a trajectory entry"""
-        if int(key) == key:
-            trj_index = key
-        else:
-            raise IndexError('index must be either an int or a sequence')
+        return int(self._entries['length'][self._row(key)])
 
-        try:
-            return len(self._handle.get_node(self._data, self._node_name(trj_index)))
-        except tables.NoSuchNodeError:
-            raise KeyError(key)
+    def shape(self, key):
+        """Get the shape of a trajectory entry"""
+        entry = self._entries[self._row(key)]
+        return (int(entry['length']),) + tuple(entry['frame_shape'][:entry['ndim']-1].tolist())
+
+    def dtype(self, key):
+        """Get the dtype of a trajectory entry"""
+        return np.dtype(self._entries['dtype'][self._row(key)])
+
+    @property
+    def stats(self):
+        """Per-feature summary statistics of all of the frames in the dataset
+
+        Returns
+        -------
+        stats : dict or None
+            A dict with the keys 'count' (the total number of frames), and
+            'mean', 'var', 'min' and 'max', which are arrays with the shape
+            of a single frame. If the statistics are not available (the
+            trajectories have frames of different shapes, or the dataset was
+            written by an older version of msmbuilder), stats is None.
+        """
+        if self._stats is None or self._stats_stale or self._stats_inconsistent \
+                or self._n_entries == 0:
+            return None
+        count, mean, m2, min, max = self._stats
+        shape = self.shape(self.keys()[0])[1:]
+        return {'count': count, 'mean': mean.reshape(shape),
+                'var': (m2 / count).reshape(shape) if count > 0 else m2.reshape(shape),
+                'min': min.reshape(shape), 'max': max.reshape(shape)}
+
+    def lengths(self, keys=None):
+        """Get the lengths of many trajectory entries at once
+
+        Parameters
+        ----------
+        keys : list of ints, optional
+            The trajectories to look up. By default, all of them, in the
+            order of `keys()`.
+
+        Returns
+        -------
+        lengths : np.ndarray, dtype=int64
+        """
+        if keys is None:
+            return self._entries['length'][self._sorted_rows()]
+        return self._entries['length'][[self._row(k) for k in keys]]
+
+    def offsets(self):
+        """Get the CSR-style offsets of the trajectories in the dataset
+
+        Returns
+        -------
+        offsets : np.ndarray, dtype=int64, shape=[len(keys())+1]
+            The frames of trajectory `keys()[i]` are rows
+            `offsets[i]:offsets[i+1]` of `flat()`.
+        """
+        offsets = np.zeros(self._n_entries + 1, dtype=np.int64)
+        np.cumsum(self.lengths(), out=offsets[1:])
+        return offsets
+
+    @_with_hdf5_lock
+    def take(self, indices):
+        """Gather frames from across the dataset by their global index
+
+        The global index of a frame is its row in `flat()`, so frame `j` of
+        trajectory `keys()[i]` has global index `offsets()[i] + j`. The
+        requested frames are grouped by trajectory, and nearby frames are
+        fetched together with a single read, so gathering many frames costs
+        far fewer HDF5 reads than indexing the dataset one frame at a time.
+
+        Parameters
+        ----------
+        indices : array_like of ints
+            The global indices of the frames to gather, in any order,
+            possibly with repeats.
+
+        Returns
+        -------
+        frames : np.ndarray, shape=[len(indices), ...]
+            `frames[i]` is the frame with global index `indices[i]`.
+        """
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        offsets = self.offsets()
+        if np.any(indices < 0) or np.any(indices >= offsets[-1]):
+            raise IndexError('global frame indices must be between 0 and %d'
+                             % (offsets[-1] - 1))
+
+        keys = self.keys()
+        if len(indices) == 0:
+            shape = self.shape(keys[0])[1:] if len(keys) > 0 else ()
+            dtype = self.dtype(keys[0]) if len(keys) > 0 else np.float64
+            return np.empty((0,) + shape, dtype=dtype)
+
+        if self.layout == 'flat':
+            return self._gather(self._mmap_flat if self._mmap_flat is not None
+                                else self._flat, indices)
+
+        trajs = np.searchsorted(offsets, indices, side='right') - 1
+        order = np.argsort(trajs, kind='mergesort')
+        bounds = np.searchsorted(trajs[order], np.arange(len(keys) + 1))
+
+        result = None
+        for i in np.where(bounds[1:] > bounds[:-1])[0]:
+            selection = order[bounds[i]:bounds[i+1]]
+            data = self._gather(self._get_array(keys[i]), indices[selection] - offsets[i])
+            if result is None:
+                result = np.empty((len(indices),) + data.shape[1:], dtype=data.dtype)
+            result[selection] = data
+        return result
+
+    @_with_hdf5_lock
+    def flat(self):
+        """Get all of the frames in the dataset, concatenated in the order of
+        `keys()`, as a single array.
+
+        With the flat layout this is a single read (or, with mmap=True, a
+        view of the memory-mapped data) and nothing is concatenated. With the
+        nodes layout, each trajectory is read directly into its place in the
+        output.
+
+        Returns
+        -------
+        X : np.ndarray, shape=[n_frames_total, ...]
+            Use `offsets()` to find the boundaries between trajectories.
+        """
+        if self.layout == 'flat':
+            if self._mmap_flat is not None:
+                return self._mmap_flat
+            if self._flat is None:
+                return np.zeros(0)
+            return self._flat.read()
+
+        keys = self.keys()
+        if len(keys) == 0:
+            return np.zeros(0)
+        offsets = self.offsets()
+        shape = self.shape(keys[0])[1:]
+        dtype = self.dtype(keys[0])
+        for key in keys:
+            if self.shape(key)[1:] != shape or self.dtype(key) != dtype:
+                raise ValueError('trajectories with different frame shapes or '
+                                 'dtypes cannot be stacked together')
+
+        X = np.empty((offsets[-1],) + shape, dtype=dtype)
+        for i, key in enumerate(keys):
+            array = self._get_array(key)
+            if self._mmap_arrays is not None:
+                X[offsets[i]:offsets[i+1]] = array
+            else:
+                array.read(out=X[offsets[i]:offsets[i+1]])
+        return X
 
     def close(self):
         "Close the HDF5 file handle"
         
         if self._open:
-            if self.mode == 'w':
-                self._append_provenance()
-        
-            self._handle.flush()
-            self._handle.close()
+            self._mmap_arrays = None
+            self._mmap_flat = None
+            with _hdf5_lock:
+                if self.mode in ['w', 'a']:
+                    self._commit_index()
+                    self._store_stats()
+                    self._append_provenance()
+
+                self._handle.flush()
+                self._handle.close()
             self._open = False
             if self in self._open_datasets:
                 self._open_datasets.remove(self)
     
     
+    def _get_array(self, key):
+        """Get the array-like object holding the `key`-th trajectory: either a
+        PyTables node or, in mmap mode, a memory-mapped numpy array"""
+        if self._mmap_arrays is not None:
+            try:
+                return self._mmap_arrays[key]
+            except KeyError:
+                raise KeyError(key)
+        row = self._row(key)
+        if self.layout == 'flat':
+            start = self._offsets()[row]
+            return _FlatSlice(self._flat, start, start + self._entries['length'][row])
+        node = self._handle.get_node(self._data, self._node_name(key))
+
+        dtype = np.dtype(self._entries['dtype'][row])
+        form = self._encoded_form(dtype, self._entries['ndim'][row])
+        if form == 'rle':
+            return _RunLengthArray(node, self._entries['length'][row], dtype)
+        elif form == 'narrow':
+            return _NarrowArray(node, dtype)
+        return node
+
+    def _pyramid_level(self, key, stride, start=0):
+        """Get the array holding the coarsest level of the pyramid that
+        contains every `stride`-th frame of the `key`-th trajectory from
+        frame `start` on, along with the stride of that level. Without a
+        suitable level, this is the full trajectory, with a stride of 1."""
+        if self._mmap_arrays is None:
+            for k in reversed(self.pyramid):
+                if stride % k == 0 and start % k == 0:
+                    self._row(key)
+                    return self._handle.get_node('/pyramid/s%d' % k, self._node_name(key)), k
+        return self._get_array(key), 1
+
+    def _write_pyramid(self, key, value, append, old_length):
+        """Add the frames in `value`, which start at frame `old_length` of
+        the `key`-th trajectory, to every level of the pyramid"""
+        name = self._node_name(key)
+        for k in self.pyramid:
+            group = self._handle.get_node('/pyramid/s%d' % k)
+            try:
+                array = self._handle.get_node(group, name)
+            except tables.NoSuchNodeError:
+                array = None
+            if array is not None and not append:
+                array.remove()
+                array = None
+
+            strided = value[(-old_length) % k::k]
+            if array is None:
+                array = self._create_earray(name, strided, where=group)
+            array.append(strided)
+
+    def _row(self, key):
+        """Get the row of the index table describing the `key`-th trajectory"""
+        self._check_key(key)
+        try:
+            return self._rows[key]
+        except KeyError:
+            raise KeyError(key)
+
+    def _load_index(self):
+        """Load the per-trajectory metadata from the index table into memory"""
+        n_rows = self._index.nrows
+        self._entries = np.zeros(n_rows, dtype=self._entry_dtype)
+        if self._handle.root._v_attrs.format_version == '1.0':
+            # version 1.0 files don't record the metadata in the index, so
+            # we have to go and look at each node, once.
+            for i, nodename in enumerate(self._index.col('nodename')):
+                node = self._handle.get_node(self._data, nodename)
+                self._entries[i] = self._make_entry(self._key_name(nodename), node.shape, node.dtype)
+        elif n_rows > 0:
+            for field in self._entry_dtype.names:
+                self._entries[field] = self._index.col(field)
+
+        self._n_entries = n_rows
+        self._rows = dict((k, i) for i, k in enumerate(self._entries['key'].tolist()))
+        self._order = None
+        self._row_offsets = None
+
+    def _sorted_rows(self):
+        """Get the rows of the index, sorted by key"""
+        if self._order is None:
+            self._order = np.argsort(self._entries['key'][:self._n_entries], kind='mergesort')
+        return self._order
+
+    def _gather(self, array, frames):
+        """Read `array[frames]`, coalescing nearby frames into single reads"""
+        if isinstance(array, np.ndarray):
+            # memory-mapped, so there is nothing to coalesce
+            return array[frames]
+
+        unique, inverse = np.unique(frames, return_inverse=True)
+        # start a new read wherever reading straight through the gap to the
+        # next requested frame would be more wasteful than seeking past it
+        breaks = np.where(np.diff(unique) > self._gather_max_gap)[0] + 1
+        starts = np.concatenate([[0], breaks])
+        stops = np.concatenate([breaks, [len(unique)]])
+
+        out = np.empty((len(unique),) + array.shape[1:], dtype=array.dtype)
+        for start, stop in zip(starts, stops):
+            lo, hi = unique[start], unique[stop-1] + 1
+            out[start:stop] = array[lo:hi][unique[start:stop] - lo]
+        return out[inverse]
+
+    def _offsets(self):
+        """Get the offset of each trajectory in the flat layout, by row of the index"""
+        if self._row_offsets is None:
+            self._row_offsets = np.zeros(self._n_entries + 1, dtype=np.int64)
+            np.cumsum(self._entries['length'][:self._n_entries], out=self._row_offsets[1:])
+        return self._row_offsets
+
+    def _load_sources(self):
+        """Load the table of processed source files into memory"""
+        self._source_table = getattr(self._handle.root, 'sources', None)
+        self._sources = {}
+        self._source_rows = {}
+        if self._source_table is not None:
+            for i, row in enumerate(self._source_table.read()):
+                self._sources[row['filename']] = (int(row['key']), float(row['mtime']), int(row['size']))
+                self._source_rows[row['filename']] = i
+
+    def _load_stats(self):
+        """Load the running per-feature moments stored with the dataset
+
+        Besides the moments themselves, `_stats_stale` is set when they have
+        to be recomputed from scratch on close, `_stats_inconsistent` when the
+        trajectories can't be summarized together (their frames have
+        different numbers of features, or aren't numbers), and
+        `_stats_unknown` when the file was written without statistics, in
+        which case they're only recomputed if the dataset is modified.
+        """
+        attrs = self._handle.root._v_attrs
+        self._stats = None
+        self._stats_stale = False
+        self._stats_inconsistent = False
+        self._stats_unknown = False
+        if not self._track_stats:
+            # this makes writes mark the statistics stale, and _store_stats
+            # then discards them
+            self._stats_unknown = True
+        elif 'stats_count' in attrs._v_attrnames:
+            if attrs.stats_count >= 0:
+                self._stats = (int(attrs.stats_count), attrs.stats_mean, attrs.stats_m2,
+                               attrs.stats_min, attrs.stats_max)
+            else:
+                self._stats_inconsistent = True
+        elif self._n_entries > 0:
+            self._stats_unknown = True
+
+    def _accumulate_stats(self, value, block_size=2**16):
+        """Merge the moments of the frames in `value` into the running
+        per-feature statistics, with the pairwise update of Chan et al."""
+        if len(value) == 0:
+            return
+        if value.dtype.kind not in 'biuf':
+            self._stats = None
+            self._stats_inconsistent = True
+            return
+
+        for start in xrange(0, len(value), block_size):
+            X = value[start:start+block_size].reshape(min(block_size, len(value) - start), -1)
+            X = X.astype(np.float64)
+            n_b = len(X)
+            mean_b = X.mean(axis=0)
+            block = (n_b, mean_b, ((X - mean_b)**2).sum(axis=0), X.min(axis=0), X.max(axis=0))
+
+            if self._stats is None:
+                self._stats = block
+                continue
+            n_a, mean_a, m2_a, min_a, max_a = self._stats
+            if len(mean_a) != len(mean_b):
+                self._stats = None
+                self._stats_inconsistent = True
+                return
+            n = n_a + n_b
+            delta = mean_b - mean_a
+            self._stats = (n, mean_a + delta * (float(n_b) / n),
+                           m2_a + block[2] + delta**2 * (float(n_a) * n_b / n),
+                           np.minimum(min_a, block[3]), np.maximum(max_a, block[4]))
+
+    def _store_stats(self):
+        """Save the running per-feature statistics as attributes of the root
+        node, recomputing them from scratch first if they're stale"""
+        attrs = self._handle.root._v_attrs
+        if not self._track_stats:
+            if self._stats_stale:
+                for name in ['stats_count', 'stats_mean', 'stats_m2', 'stats_min', 'stats_max']:
+                    if name in attrs._v_attrnames:
+                        delattr(attrs, name)
+            return
+
+        if self._stats_stale:
+            self._stats = None
+            self._stats_stale = self._stats_inconsistent = self._stats_unknown = False
+            for key, offset, data in self.iter_chunks(2**16):
+                self._accumulate_stats(data)
+                if self._stats_inconsistent:
+                    break
+
+        if self._stats_inconsistent:
+            attrs.stats_count = -1
+        elif self._stats is not None:
+            attrs.stats_count, attrs.stats_mean, attrs.stats_m2, \
+                attrs.stats_min, attrs.stats_max = self._stats
+
+    def _make_entry(self, key, shape, dtype):
+        if len(shape) - 1 > _MAX_FRAME_NDIM:
+            raise ValueError('frames can have at most %d dimensions' % _MAX_FRAME_NDIM)
+        frame_shape = np.zeros(_MAX_FRAME_NDIM, dtype=np.int64)
+        frame_shape[:len(shape)-1] = shape[1:]
+        return (key, shape[0], len(shape), frame_shape, np.dtype(dtype).str)
+
+    def _update_index(self, key, shape, dtype):
+        """Record the shape and dtype of the `key`-th trajectory, both in
+        memory and in the index table"""
+        entry = self._make_entry(key, shape, dtype)
+        if key in self._rows:
+            row = self._rows[key]
+            self._entries[row] = entry
+            self._dirty_rows.add(row)
+        else:
+            row = self._n_entries
+            if row == len(self._entries):
+                # grow geometrically, so that adding n trajectories is O(n)
+                entries = np.zeros(max(16, 2*len(self._entries)), dtype=self._entry_dtype)
+                entries[:row] = self._entries[:row]
+                self._entries = entries
+            self._entries[row] = entry
+            self._n_entries += 1
+            self._rows[key] = row
+            self._order = None
+
+            for name, value in zip(self._entry_dtype.names, entry):
+                self._index.row[name] = value
+            self._index.row['nodename'] = self._node_name(key)
+            self._index.row.append()
+        self._row_offsets = None
+
+    @_with_hdf5_lock
+    def _flush(self):
+        """Commit pending index updates and flush the file, unless we're
+        inside of a batch"""
+        if self._batch_depth > 0:
+            return
+        self._commit_index()
+        self._handle.flush()
+
+    @_with_hdf5_lock
+    def _commit_index(self):
+        """Write the index rows and filenames that have been updated in
+        memory out to the index table"""
+        # new rows were buffered by PyTables with Row.append()
+        self._index.flush()
+        if self._source_table is not None:
+            self._source_table.flush()
+        for row in sorted(self._dirty_rows):
+            for name in self._entry_dtype.names[1:]:
+                self._index.cols._f_col(name)[row] = self._entries[row][name]
+        for row, filename in sorted(self._pending_filenames.iteritems()):
+            self._index.cols.filename[row] = filename
+        self._dirty_rows.clear()
+        self._pending_filenames.clear()
+
+    def _load_mmap(self, filename):
+        """Memory-map the raw sidecar file holding every trajectory in this
+        dataset, rebuilding it first if it is missing or out of date.
+
+        PyTables gives us no way of finding where the contiguous data for an
+        array lives inside the HDF5 file, so we keep a raw copy next to it
+        instead. The sidecar has no header: each trajectory is stored in C
+        order, in the order of `keys()`, starting on a 64-byte boundary, so
+        the offsets follow directly from the shapes and dtypes of the nodes.
+        With the flat layout, the sidecar is simply a copy of the flat array.
+        """
+        if self.encoding is not None:
+            raise ValueError('Encoded datasets cannot be opened with mmap=True')
+        if self.layout == 'flat':
+            arrays = [(None, self._flat)] if self._flat is not None else []
+        else:
+            arrays = [(key, self._get_array(key)) for key in self.keys()]
+
+        layout = []
+        offset = 0
+        for key, array in arrays:
+            if array.filters.complevel != 0:
+                raise ValueError('Only uncompressed datasets can be opened with '
+                                 'mmap=True')
+            offset = -(-offset // self._mmap_alignment) * self._mmap_alignment
+            nbytes = int(np.prod(array.shape)) * array.dtype.itemsize
+            layout.append((array, offset, nbytes, array.shape, array.dtype))
+            offset += nbytes
+
+        sidecar = filename + '.mmap'
+        if not os.path.exists(sidecar) or os.path.getmtime(sidecar) < os.path.getmtime(filename) \
+                or os.path.getsize(sidecar) != offset:
+            self._write_mmap(sidecar, layout)
+
+        if offset == 0:
+            # np.memmap refuses to map empty files
+            buffer = np.zeros(0, dtype=np.uint8)
+        else:
+            buffer = np.memmap(sidecar, dtype=np.uint8, mode='r')
+        views = [buffer[o:o+n].view(dtype).reshape(shape) for _, o, n, shape, dtype in layout]
+
+        if self.layout == 'flat':
+            if len(views) == 0:
+                return {}
+            self._mmap_flat = views[0]
+            offsets = self._offsets()
+            return dict((key, self._mmap_flat[offsets[row]:offsets[row+1]])
+                        for key, row in self._rows.iteritems())
+        return dict((key, view) for (key, _), view in zip(arrays, views))
+
+    def _write_mmap(self, sidecar, layout, chunk_size=2**16):
+        # write to a temporary file and move it into place, so that concurrent
+        # readers never see a partially written sidecar
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(sidecar)))
+        with os.fdopen(fd, 'wb') as f:
+            for array, offset, nbytes, shape, dtype in layout:
+                f.seek(offset)
+                for start in xrange(0, len(array), chunk_size):
+                    f.write(np.ascontiguousarray(array[start:start+chunk_size]).tostring())
+            f.truncate(layout[-1][1] + layout[-1][2] if len(layout) > 0 else 0)
+        os.chmod(tmpname, 0o644)
+        os.rename(tmpname, sidecar)
+
+    def _write(self, key, value, append):
+        with _hdf5_lock:
+            self._check_key(key)
+            if not isinstance(value, np.ndarray):
+                raise TypeError('value must be a numpy array. You supplied %s of '
+                                'type %s' % (value, type(value)))
+            if value.ndim == 0:
+                raise ValueError('value must be at least one dimensional')
+
+            replacing = key in self._rows and not append
+            old_length = 0
+            if append and key in self._rows:
+                old_length = self._entries['length'][self._rows[key]]
+            if self.layout == 'flat':
+                shape, dtype = self._write_flat(key, value, append)
+            else:
+                shape, dtype = self._write_nodes(key, value, append)
+            # the pyramid holds the frames as they were stored, after any
+            # cast into the dtype of the existing array
+            self._write_pyramid(key, value.astype(dtype, copy=False), append, old_length)
+            self._update_index(key, shape, dtype)
+
+            if replacing or self._stats_unknown:
+                # there's no way to take the old frames back out of the running
+                # moments (or, for a file written without statistics, nothing
+                # to merge the new frames into), so they'll have to be
+                # recomputed from scratch on close
+                self._stats_stale = True
+            elif not (self._stats_stale or self._stats_inconsistent):
+                self._accumulate_stats(value)
+            self._flush()
+
+    def _encoded_form(self, dtype, ndim):
+        """How a trajectory with the given (decoded) dtype and number of
+        dimensions is encoded: None, 'narrow', or 'rle'"""
+        if self.encoding is None or np.dtype(dtype).kind not in 'iu':
+            return None
+        if self.encoding == 'rle' and ndim == 1:
+            return 'rle'
+        return 'narrow'
+
+    def _write_nodes(self, key, value, append):
+        if append and key in self._rows:
+            row = self._rows[key]
+            form = self._encoded_form(self._entries['dtype'][row], self._entries['ndim'][row])
+        else:
+            form = self._encoded_form(value.dtype, value.ndim)
+        if form is not None:
+            return self._write_encoded(key, value, append, form)
+
+        try:
+            array = self._handle.get_node(self._data, name=self._node_name(key))
+        except tables.NoSuchNodeError:
+            array = None
+
+        if append and array is not None:
+            if array.shape[1:] != value.shape[1:]:
+                raise ValueError('The shape of the frames in value, %s, does not '
+                                 'match the shape of the frames already stored, %s'
+                                 % (str(value.shape[1:]), str(array.shape[1:])))
+        elif array is not None and (array.shape[1:] != value.shape[1:] or array.dtype != value.dtype):
+            # the new data doesn't fit in the old extendable array, so it
+            # needs to be thrown away entirely
+            array.remove()
+            array = self._create_earray(self._node_name(key), value)
+        elif array is not None:
+            array.truncate(0)
+        else:
+            array = self._create_earray(self._node_name(key), value)
+
+        array.append(value)
+        return array.shape, array.dtype
+
+    def _write_encoded(self, key, value, append, form):
+        name = self._node_name(key)
+        try:
+            array = self._handle.get_node(self._data, name=name)
+        except tables.NoSuchNodeError:
+            array = None
+        if not append and array is not None:
+            array.remove()
+            array = None
+
+        if array is not None:
+            shape = self.shape(key)
+            if shape[1:] != value.shape[1:]:
+                raise ValueError('The shape of the frames in value, %s, does not '
+                                 'match the shape of the frames already stored, %s'
+                                 % (str(value.shape[1:]), str(shape[1:])))
+            length, dtype = shape[0], self.dtype(key)
+        else:
+            length, dtype = 0, value.dtype
+
+        if form == 'rle':
+            # store (start, value) pairs, one per run
+            starts = _run_starts(value)
+            encoded = np.empty((len(starts), 2), dtype=np.int64 if value.dtype.kind == 'i' else np.uint64)
+            encoded[:, 0] = starts + length
+            encoded[:, 1] = value[starts]
+            if array is not None and len(array) > 0 and len(encoded) > 0 and \
+                    encoded[0, 1] == array[-1, 1]:
+                # the first new run continues the last stored one
+                encoded = encoded[1:]
+            lo = min(value.min(), 0) if len(value) > 0 else 0
+            hi = max(value.max() if len(value) > 0 else 0, length + len(value))
+        else:
+            encoded = value
+            lo, hi = (value.min(), value.max()) if value.size > 0 else (0, 0)
+
+        narrow = _narrow_dtype(lo, hi)
+        if array is not None and not np.can_cast(narrow, array.dtype):
+            # the new values don't fit in the stored dtype, so widen it
+            narrow = np.promote_types(narrow, array.dtype)
+            if narrow.kind == 'f':
+                narrow = np.dtype(np.int64)
+            encoded = np.concatenate([array.read().astype(narrow), encoded.astype(narrow)])
+            array.remove()
+            array = None
+        encoded = encoded.astype(array.dtype if array is not None else narrow)
+
+        if array is None:
+            array = self._create_earray(name, encoded)
+        array.append(encoded)
+        return (length + len(value),) + value.shape[1:], dtype
+
+    def _write_flat(self, key, value, append):
+        if self._flat is None:
+            self._flat = self._create_earray('frames', value)
+        if self._flat.shape[1:] != value.shape[1:]:
+            raise ValueError('In the flat layout, every trajectory must have frames '
+                             'of the same shape. You supplied frames of shape %s, '
+                             'but the dataset contains frames of shape %s'
+                             % (str(value.shape[1:]), str(self._flat.shape[1:])))
+        if value.dtype != self._flat.dtype:
+            if not np.can_cast(value.dtype, self._flat.dtype):
+                raise ValueError('In the flat layout, every trajectory must have the '
+                                 'same dtype. You supplied %s, but the dataset '
+                                 'contains %s' % (value.dtype, self._flat.dtype))
+            value = value.astype(self._flat.dtype)
+
+        if key in self._rows:
+            row = self._rows[key]
+            length = self._entries['length'][row]
+            if append:
+                if row != self._n_entries - 1:
+                    raise ValueError('In the flat layout, frames can only be '
+                                     'appended to the last trajectory')
+                self._flat.append(value)
+                length += len(value)
+            else:
+                if len(value) != length:
+                    raise ValueError('In the flat layout, a trajectory can only be '
+                                     'overwritten with the same number of frames')
+                start = self._offsets()[row]
+                self._flat[start:start+length] = value
+        else:
+            if self._n_entries > 0 and key < self._entries['key'][self._n_entries-1]:
+                raise ValueError('In the flat layout, trajectories must be added '
+                                 'in order of increasing key')
+            self._flat.append(value)
+            length = len(value)
+
+        return (length,) + value.shape[1:], self._flat.dtype
+
+    def _check_key(self, key):
+        if not np.isscalar(key) or key != int(key):
+            raise TypeError('key must be an int. You supplied %s of type %s'
+                            % (key, type(key)))
+
+    def _create_earray(self, name, value, where=None):
+        """Create an extendable array in the data group (or in `where`), with
+        the dtype and frame shape of `value`"""
+        chunkshape = self.chunkshape
+        if self.column_block is not None and value.ndim > 1 and \
+                (chunkshape is None or np.isscalar(chunkshape)):
+            block = (max(min(self.column_block, value.shape[1]), 1),) + value.shape[2:]
+            if chunkshape is None:
+                chunkshape = max(self._column_chunk_bytes // (value.itemsize * np.prod(block)), 1)
+            chunkshape = (int(chunkshape),) + block
+        elif chunkshape is not None and np.isscalar(chunkshape):
+            chunkshape = (int(chunkshape),) + value.shape[1:]
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=tables.NaturalNameWarning)
+            return self._handle.create_earray(
+                self._data if where is None else where, name=name,
+                atom=tables.Atom.from_dtype(value.dtype),
+                shape=(0,) + value.shape[1:], expectedrows=max(len(value), 1),
+                chunkshape=chunkshape)
+
     # Methods for translating internally from pytables node names to the keys
     # used externally. These methods need to do the inverse of one another
     def _node_name(self, key):
@@ -249,10 +1333,10 @@ class DataSet(object):
     def _key_name(self, node_name):
         return int(node_name)
 
-    @ensure_mode('w')
+    @ensure_mode('w', 'a')
     def _append_provenance(self):
         """Append current provence information to this file. This method is called
-        automatically when datasets opened in mode='w' are closed."""
+        automatically when datasets opened in mode='w' or 'a' are closed."""
         if self._appended_provenance:
             return 
         self._provenance.row['user'] = getpass.getuser()
@@ -269,10 +1353,368 @@ class DataSet(object):
         
     def __str__(self):
         return '<DataSet name=%(name)s, n_trajs=%(n_trajs)s, timestep=%(timestep)s>' \
-            % {'name': self.name, 'n_trajs': len(self.keys()), 'timestep': self.timestep}
+            % {'name': self.name, 'n_trajs': self._n_entries, 'timestep': self.timestep}
     def __repr__(self):
         return str(self)
 
+class _FlatSlice(object):
+    """A view of the rows `start:stop` of a PyTables array, which can be
+    indexed like the array holding a single trajectory in the nodes layout.
+    Nothing is read from disk until the view is indexed."""
+
+    def __init__(self, array, start, stop):
+        self.array = array
+        self.start = int(start)
+        self.stop = int(stop)
+        self.shape = (self.stop - self.start,) + array.shape[1:]
+        self.dtype = array.dtype
+        self.filters = array.filters
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def read(self, start=None, stop=None, step=None, out=None):
+        start, stop, step = slice(start, stop, step).indices(len(self))
+        return self.array.read(self.start + start, self.start + stop, step, out=out)
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        first, rest = index[0], index[1:]
+
+        if isinstance(first, slice):
+            start, stop, step = first.indices(len(self))
+            if step < 0:
+                # read forwards, then flip
+                frames = np.arange(start, stop, step)
+                if len(frames) == 0:
+                    return self.array[(slice(0, 0),) + rest]
+                return self[(slice(frames[-1], frames[0]+1, -step),) + rest][::-1]
+            first = slice(self.start + start, self.start + max(start, stop), step)
+        elif np.isscalar(first):
+            if not -len(self) <= first < len(self):
+                raise IndexError('index %d is out of bounds for a trajectory of '
+                                 'length %d' % (first, len(self)))
+            first = self.start + (first % len(self))
+        else:
+            first = np.asarray(first)
+            if first.dtype == np.bool_:
+                first = np.where(first)[0]
+            if np.any(first >= len(self)) or np.any(first < -len(self)):
+                raise IndexError('index out of bounds for a trajectory of '
+                                 'length %d' % len(self))
+            first = self.start + (first % len(self))
+            # PyTables wants its fancy selections sorted and unique, and
+            # mistakes a lone list of indices for a point selection
+            unique, inverse = np.unique(first, return_inverse=True)
+            return self.array[(unique.tolist(),) + (rest or (Ellipsis,))][inverse]
+
+        return self.array[(first,) + rest]
+
+
+class _NarrowArray(object):
+    """A PyTables array stored with a narrower integer dtype than its data,
+    which can be indexed like the original array"""
+
+    def __init__(self, array, dtype):
+        self.array = array
+        self.shape = array.shape
+        self.dtype = np.dtype(dtype)
+        self.filters = array.filters
+
+    def __len__(self):
+        return len(self.array)
+
+    def read(self, start=None, stop=None, step=None, out=None):
+        data = self.array.read(start, stop, step)
+        if out is None:
+            return data.astype(self.dtype)
+        out[...] = data
+        return out
+
+    def __getitem__(self, index):
+        return np.asarray(self.array[index]).astype(self.dtype)
+
+
+class _RunLengthArray(object):
+    """A one dimensional trajectory stored as a PyTables array of
+    (start, value) pairs, one per run, which can be indexed like the
+    decoded trajectory. The runs are read in full the first time the
+    array is indexed."""
+
+    def __init__(self, array, length, dtype):
+        self.array = array
+        self.shape = (int(length),)
+        self.dtype = np.dtype(dtype)
+        self.filters = array.filters
+        self._runs = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def runs(self):
+        """Get the start frame and the value of each run"""
+        if self._runs is None:
+            runs = self.array.read()
+            self._runs = runs[:, 0].astype(np.int64), runs[:, 1].astype(self.dtype)
+        return self._runs
+
+    def read(self, start=None, stop=None, step=None, out=None):
+        data = self[slice(start, stop, step)]
+        if out is None:
+            return data
+        out[...] = data
+        return out
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            if len(index) > 1 and any(i is not Ellipsis for i in index[1:]):
+                raise IndexError('too many indices')
+            index = index[0]
+
+        if isinstance(index, slice):
+            frames = np.arange(*index.indices(len(self)))
+            if len(frames) == 0:
+                return np.empty(0, dtype=self.dtype)
+            lo, hi = frames.min(), frames.max() + 1
+            return self._decode(lo, hi)[frames - lo]
+
+        frames = np.asarray(index)
+        if frames.dtype == np.bool_:
+            frames = np.where(frames)[0]
+        if np.any(frames >= len(self)) or np.any(frames < -len(self)):
+            raise IndexError('index out of bounds for a trajectory of length %d'
+                             % len(self))
+        starts, values = self.runs()
+        result = values[np.searchsorted(starts, frames % len(self), side='right') - 1]
+        return result[()] if result.ndim == 0 else result
+
+    def _decode(self, lo, hi):
+        """Decode the frames `lo:hi`"""
+        starts, values = self.runs()
+        first = np.searchsorted(starts, lo, side='right') - 1
+        last = np.searchsorted(starts, hi, side='left')
+        bounds = np.clip(np.append(starts[first:last], hi), lo, hi)
+        return np.repeat(values[first:last], np.diff(bounds))
+
+
+def _read_columns(array, columns, frames):
+    """Read `array[frames][:, columns]`, with one read per contiguous run of
+    the requested columns"""
+    if len(array.shape) < 2:
+        raise ValueError('columns can only be selected from trajectories with '
+                         'more than one dimension')
+    columns = np.asarray(columns, dtype=np.int64).reshape(-1)
+    n_columns = array.shape[1]
+    if np.any(columns >= n_columns) or np.any(columns < -n_columns):
+        raise IndexError('column index out of bounds for %d columns' % n_columns)
+    unique, inverse = np.unique(columns % n_columns if n_columns else columns,
+                                return_inverse=True)
+
+    breaks = np.where(np.diff(unique) > 1)[0] + 1
+    parts = [array[frames, run[0]:run[-1]+1] for run in np.split(unique, breaks) if len(run) > 0]
+    if len(parts) == 0:
+        return array[frames, 0:0]
+    return np.concatenate(parts, axis=1)[:, inverse]
+
+
+def _run_starts(x):
+    """Get the index of the first element of each run of repeated values
+    in the one dimensional array `x`"""
+    if len(x) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate([[0], np.where(x[1:] != x[:-1])[0] + 1])
+
+
+def _narrow_dtype(lo, hi):
+    """Get the smallest integer dtype that can hold every value between
+    `lo` and `hi`, preferring unsigned dtypes"""
+    candidates = [np.int8, np.int16, np.int32, np.int64]
+    if lo >= 0:
+        candidates = [np.uint8, np.uint16, np.uint32, np.uint64]
+    for dtype in candidates:
+        info = np.iinfo(dtype)
+        if info.min <= lo and hi <= info.max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def _make_filters(compression, complevel=None, shuffle='byte'):
+    """Build the `tables.Filters` for one of the `compression` options
+    accepted by `DataSet`"""
+    if compression is None or isinstance(compression, tables.Filters):
+        return compression
+    # PyTables wants a plain str, not unicode
+    compression = str(compression)
+    if not shuffle in ['byte', 'bit', None]:
+        raise ValueError("shuffle must be one of ['byte', 'bit', None]")
+
+    if compression == 'zlib':
+        if shuffle == 'bit':
+            raise ValueError("shuffle='bit' is only available with blosc")
+        return tables.Filters(complib='zlib', complevel=1 if complevel is None else complevel,
+                              shuffle=shuffle == 'byte')
+
+    codec = compression[len('blosc:'):] if str(compression).startswith('blosc:') else None
+    if compression != 'blosc' and codec not in tables.blosc_compressor_list():
+        raise ValueError("compression must be either 'zlib', 'blosc', 'blosc:<codec>' "
+                         "with codec one of %s, or None" % tables.blosc_compressor_list())
+    return tables.Filters(complib=compression, complevel=9 if complevel is None else complevel,
+                          shuffle=shuffle == 'byte', bitshuffle=shuffle == 'bit')
+
+
+def tune_compression(dataset, target='read', n_samples=3, max_frames=10000,
+                     candidates=None):
+    """Compare compression options on a sample of the trajectories in a
+    dataset
+
+    A few trajectories are copied, with each candidate set of compression
+    options, into an HDF5 file held in memory and read back, and the
+    options are ranked by the resulting read throughput or compression
+    ratio.
+
+    Parameters
+    ----------
+    dataset : DataSet
+        The (open) dataset to sample from.
+    target : {'read', 'write', 'ratio'}
+        Rank the options by read throughput, write throughput, or
+        compression ratio.
+    n_samples : int
+        The number of trajectories to sample, spread evenly over `keys()`.
+    max_frames : int
+        Only use the first `max_frames` frames of each sampled trajectory.
+    candidates : list of dicts, optional
+        The options to compare, each a dict of the `compression`,
+        `complevel` and `shuffle` arguments to `DataSet`. By default, every
+        blosc codec from lz4, zstd and blosclz at levels 1, 5 and 9 with byte
+        and bit shuffling, zlib at level 1, and no compression.
+
+    Returns
+    -------
+    results : list of dicts
+        One entry per candidate, best first, giving the options under
+        'options' (so that `DataSet(filename, 'w', **results[0]['options'])`
+        uses the best ones) along with the measured 'ratio', 'read_MBps'
+        and 'write_MBps'.
+    """
+    if not target in ['read', 'write', 'ratio']:
+        raise ValueError("target must be one of ['read', 'write', 'ratio']")
+    if candidates is None:
+        candidates = [{'compression': None}, {'compression': 'zlib', 'complevel': 1}]
+        for codec in ['lz4', 'zstd', 'blosclz']:
+            if codec not in tables.blosc_compressor_list():
+                continue
+            for complevel in [1, 5, 9]:
+                for shuffle in ['byte', 'bit']:
+                    candidates.append({'compression': 'blosc:%s' % codec,
+                                       'complevel': complevel, 'shuffle': shuffle})
+
+    keys = dataset.keys()
+    keys = [keys[i] for i in np.unique(np.linspace(0, len(keys) - 1, n_samples).astype(int))] if keys else []
+    samples = [np.ascontiguousarray(dataset[key, :max_frames]) for key in keys]
+    samples = [x for x in samples if len(x) > 0]
+    if len(samples) == 0:
+        raise ValueError('the dataset contains no data to sample')
+    nbytes = float(sum(x.nbytes for x in samples))
+
+    results = []
+    for options in candidates:
+        filters = _make_filters(options.get('compression'), options.get('complevel'),
+                                options.get('shuffle', 'byte'))
+        handle = tables.open_file('tune_compression.h5', 'w', driver='H5FD_CORE',
+                                  driver_core_backing_store=0)
+        try:
+            start = time.time()
+            for i, x in enumerate(samples):
+                handle.create_earray(handle.root, 'x%d' % i, obj=x, filters=filters,
+                                     expectedrows=len(x))
+            handle.flush()
+            write_time = time.time() - start
+            stored = sum(node.size_on_disk for node in handle.walk_nodes('/', 'Leaf'))
+
+            # reads are quick and noisy, so keep the best of a few
+            read_time = np.inf
+            for repeat in range(3):
+                start = time.time()
+                for node in handle.walk_nodes('/', 'Leaf'):
+                    node.read()
+                read_time = min(read_time, time.time() - start)
+        finally:
+            handle.close()
+
+        results.append({'options': options,
+                        'ratio': nbytes / max(stored, 1),
+                        'read_MBps': nbytes / 1e6 / max(read_time, 1e-9),
+                        'write_MBps': nbytes / 1e6 / max(write_time, 1e-9)})
+
+    column = {'read': 'read_MBps', 'write': 'write_MBps', 'ratio': 'ratio'}[target]
+    return sorted(results, key=lambda r: r[column], reverse=True)
+
+
+def _prefetch(blocks, depth, max_bytes=None):
+    """Consume the iterator `blocks` of (key, offset, data) tuples on a
+    background thread, keeping at most `depth` blocks (and, roughly,
+    `max_bytes` bytes of data) queued up ahead of the caller.
+    """
+    queue = collections.deque()
+    cond = threading.Condition()
+    state = {'nbytes': 0, 'done': False, 'closed': False, 'error': None}
+
+    def full():
+        if len(queue) == 0:
+            return False
+        return len(queue) >= depth or (max_bytes is not None and
+                                       state['nbytes'] >= max_bytes)
+
+    def worker():
+        try:
+            while True:
+                with cond:
+                    while full() and not state['closed']:
+                        cond.wait()
+                    if state['closed']:
+                        return
+                with _hdf5_lock:
+                    try:
+                        item = next(blocks)
+                    except StopIteration:
+                        return
+                with cond:
+                    queue.append(item)
+                    state['nbytes'] += item[-1].nbytes
+                    cond.notify_all()
+        except Exception:
+            state['error'] = sys.exc_info()
+        finally:
+            with cond:
+                state['done'] = True
+                cond.notify_all()
+
+    thread = threading.Thread(target=worker, name='DataSet-prefetch')
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            with cond:
+                while len(queue) == 0 and not state['done']:
+                    cond.wait()
+                if len(queue) == 0:
+                    break
+                item = queue.popleft()
+                state['nbytes'] -= item[-1].nbytes
+                cond.notify_all()
+            yield item
+        if state['error'] is not None:
+            error = state['error']
+            raise error[0], error[1], error[2]
+    finally:
+        with cond:
+            state['closed'] = True
+            cond.notify_all()
+        thread.join()
+
+
 # Close datasets when the interpreter exits.
 def _close():
     for v in DataSet._open_datasets:
@@ -0,0 +1,261 @@
+"""Storage for data derived from mappings of molecular dynamics trajectories,
+which can be read while it is still being written
+"""
+# stdlib
+import os
+import json
+import time
+import glob
+
+import numpy as np
+from msmbuilder3.dataset import DataSet, _prefetch
+
+
+class LiveDataSet(object):
+    """A dataset, stored as an append-only log of DataSet segments, that can
+    be read while it is being written
+
+    HDF5 files can't safely be opened while another process is writing
+    them (and PyTables does not support HDF5's SWMR mode). So the writer
+    collects trajectories in a segment file, an ordinary `DataSet`, and
+    every so often closes the segment and publishes it by appending a line
+    to the `LOG` file. Readers only ever open published segments, which are
+    never modified again, and pick up new ones with `refresh` or `follow`.
+
+    The dataset is a directory holding the segments and the `LOG`.
+
+    Parameters
+    ----------
+    dirname : str
+        The directory holding the dataset.
+    mode : {'r', 'w', 'a'}
+        Open the dataset to read ('r'), write ('w') or append ('a'). In mode
+        'w', any existing dataset in the directory is removed.
+    segment_size : int
+        In mode 'w' or 'a', publish the current segment before starting a
+        new trajectory once it holds this many trajectories...
+    commit_interval : float
+        ... or once it was started at least this many seconds ago.
+    **kwargs
+        Passed on to the `DataSet` of each segment written.
+
+    Notes
+    -----
+    A trajectory becomes visible to readers when the segment holding it is
+    published, so it must be written completely (with `__setitem__`, or a
+    series of `append` calls) before any other trajectory is started.
+    Writing a trajectory again in a later segment replaces it.
+    """
+
+    _log_name = 'LOG'
+
+    def __init__(self, dirname, mode='r', segment_size=100, commit_interval=30.0, **kwargs):
+        if not mode in ['r', 'w', 'a']:
+            raise ValueError("mode must be one of ['r', 'w', 'a']")
+        self.dirname = dirname
+        self.mode = mode
+        self.segment_size = segment_size
+        self.commit_interval = commit_interval
+        self.closed = False
+        self._kwargs = kwargs
+        self._segments = []
+        self._key_map = {}
+        self._log_offset = 0
+        self._current = None
+        self._current_keys = []
+
+        if mode == 'w':
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            for fn in glob.glob(os.path.join(dirname, 'segment-*.h5')) + [self._log_filename]:
+                if os.path.exists(fn):
+                    os.unlink(fn)
+            open(self._log_filename, 'w').close()
+        elif not os.path.exists(self._log_filename):
+            raise IOError('%s is not a live msmbuilder dataset' % dirname)
+        if mode == 'a':
+            # let readers know that the dataset is being written again, even
+            # before anything new is published
+            self._write_log({'open': True})
+        self.refresh()
+
+    @property
+    def _log_filename(self):
+        return os.path.join(self.dirname, self._log_name)
+
+    def refresh(self):
+        """Open any segments that have been published since the last refresh
+
+        Returns
+        -------
+        keys : list of ints
+            The keys of the trajectories that were published (or replaced)
+        """
+        with open(self._log_filename) as f:
+            f.seek(self._log_offset)
+            lines = f.read()
+        # the last line may still be in the middle of being written
+        lines = lines[:lines.rfind('\n') + 1]
+        self._log_offset += len(lines)
+
+        keys = []
+        for line in lines.splitlines():
+            entry = json.loads(line)
+            if entry.get('closed'):
+                self.closed = True
+            if entry.get('open'):
+                self.closed = False
+            if 'segment' in entry:
+                self.closed = False
+                self._segments.append(DataSet(os.path.join(self.dirname, entry['segment'])))
+                for key in entry['keys']:
+                    self._key_map[key] = len(self._segments) - 1
+                keys.extend(entry['keys'])
+        return keys
+
+    def follow(self, poll_interval=1.0, timeout=None):
+        """Yield the key of each trajectory as it is published, starting
+        with those already published, until the writer closes the dataset
+
+        Parameters
+        ----------
+        poll_interval : float
+            Seconds to wait between checks for new segments.
+        timeout : float, optional
+            Stop if nothing new is published for this many seconds.
+        """
+        for key in self.keys():
+            yield key
+        last = time.time()
+        while not self.closed:
+            keys = self.refresh()
+            for key in keys:
+                yield key
+            if len(keys) > 0:
+                last = time.time()
+            elif timeout is not None and time.time() - last > timeout:
+                return
+            else:
+                time.sleep(poll_interval)
+
+    def keys(self):
+        "Get the (sorted) list of the keys of the published trajectories"
+        return sorted(self._key_map)
+
+    def __getitem__(self, key):
+        trj_index = key[0] if isinstance(key, tuple) else key
+        return self._segment(trj_index)[key]
+
+    def iter_chunks(self, chunk_size=10000, stride=1, lag=0, keys=None,
+                    columns=None, prefetch=0, prefetch_bytes=None):
+        """Iterate over the published trajectories in blocks of at most
+        `chunk_size` frames. See `DataSet.iter_chunks` for details."""
+        if keys is None:
+            keys = self.keys()
+        for key in keys:
+            self._segment(key)
+
+        blocks = self._iter_chunks(chunk_size, stride, lag, keys, columns)
+        if prefetch > 0:
+            return _prefetch(blocks, prefetch, prefetch_bytes)
+        return blocks
+
+    def _iter_chunks(self, chunk_size, stride, lag, keys, columns):
+        for key in keys:
+            for block in self._segment(key).iter_chunks(chunk_size, stride, lag, [key], columns):
+                yield block
+
+    def get_trajfn(self, key):
+        return self._segment(key).get_trajfn(key)
+
+    def length(self, key):
+        """Get the length of a trajectory entry"""
+        return self._segment(key).length(key)
+
+    def shape(self, key):
+        """Get the shape of a trajectory entry"""
+        return self._segment(key).shape(key)
+
+    def dtype(self, key):
+        """Get the dtype of a trajectory entry"""
+        return self._segment(key).dtype(key)
+
+    def lengths(self, keys=None):
+        """Get the lengths of many trajectory entries at once, by default
+        in the order of `keys()`"""
+        if keys is None:
+            keys = self.keys()
+        return np.array([self.length(key) for key in keys], dtype=np.int64)
+
+    def __setitem__(self, key, value):
+        "Set data on the `key`-th trajectory of the dataset."
+        self._writer(key)[key] = value
+
+    def append(self, key, value):
+        "Append frames to the end of the `key`-th trajectory of the dataset."
+        self._writer(key).append(key, value)
+
+    def set_trajfn(self, key, value):
+        self._writer(key).set_trajfn(key, value)
+
+    def commit(self):
+        "Publish the trajectories written since the last commit"
+        if self._current is None:
+            return
+        filename = self._current_filename
+        self._current.close()
+        self._current = None
+        if len(self._current_keys) == 0:
+            os.unlink(filename)
+            return
+        self._write_log({'segment': os.path.basename(filename), 'keys': self._current_keys})
+        self._current_keys = []
+        self.refresh()
+
+    def close(self):
+        "Publish any outstanding trajectories, and close every segment"
+        if self.mode in ['w', 'a']:
+            self.commit()
+            self._write_log({'closed': True})
+            self.mode = 'r'
+        for segment in self._segments:
+            segment.close()
+
+    def _segment(self, key):
+        """Get the DataSet of the published segment holding trajectory `key`"""
+        try:
+            return self._segments[self._key_map[key]]
+        except KeyError:
+            raise KeyError(key)
+
+    def _writer(self, key):
+        """Get the DataSet of the segment that trajectory `key` should be
+        written to, starting a new segment if it's time to"""
+        if self.mode not in ['w', 'a']:
+            raise ValueError('Cannot write to a LiveDataSet opened in mode="%s"' % self.mode)
+        if self._current is not None and key not in self._current_keys and \
+                (len(self._current_keys) >= self.segment_size or
+                 time.time() - self._started >= self.commit_interval):
+            self.commit()
+
+        if self._current is None:
+            index = len(glob.glob(os.path.join(self.dirname, 'segment-*.h5')))
+            self._current_filename = os.path.join(self.dirname, 'segment-%06d.h5' % index)
+            self._current = DataSet(self._current_filename, 'w', **self._kwargs)
+            self._started = time.time()
+        if key not in self._current_keys:
+            self._current_keys.append(key)
+        return self._current
+
+    def _write_log(self, entry):
+        with open(self._log_filename, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def __str__(self):
+        return '<LiveDataSet dirname=%(dirname)s, n_trajs=%(n_trajs)s, n_segments=%(n_segments)s>' \
+            % {'dirname': self.dirname, 'n_trajs': len(self._key_map),
+               'n_segments': len(self._segments)}
+    def __repr__(self):
+        return str(self)
@@ -0,0 +1,257 @@
+"""In-memory storage for data derived from mappings of molecular dynamics
+trajectories, which spills to disk beyond a memory budget
+"""
+# stdlib
+import os
+import tempfile
+import contextlib
+import collections
+
+import numpy as np
+from msmbuilder3.dataset import DataSet, _prefetch, _read_columns
+
+
+class MemoryDataSet(object):
+    """A DataSet that keeps its trajectories in memory, up to a budget
+
+    This has the same interface as `DataSet` for reading and writing
+    trajectories, but keeps them as numpy arrays, so that data can be
+    handed from one stage of a pipeline to the next without going through
+    a file. Once the arrays take up more than `max_bytes`, the least
+    recently used trajectories are moved to a temporary (lightly
+    compressed) HDF5 DataSet, which is deleted on `close`. Reading a whole
+    spilled trajectory brings it back into memory.
+
+    Parameters
+    ----------
+    max_bytes : int
+        The largest number of bytes of trajectory data to keep in memory.
+    spill_dir : str, optional
+        The directory in which to create the temporary file. By default,
+        the system's temporary directory.
+
+    Notes
+    -----
+    Arrays are stored without being copied, so they should not be
+    modified after being written.
+    """
+
+    def __init__(self, max_bytes=2**30, spill_dir=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.nbytes = 0
+        self._arrays = collections.OrderedDict()
+        self._shapes = {}
+        self._dtypes = {}
+        self._trajfns = {}
+        # the keys of the trajectories in memory whose copy in the spill
+        # file is still up to date, which can be dropped without writing
+        self._clean = set()
+        self._spill = None
+        self._spill_filename = None
+
+    def __setitem__(self, key, value):
+        "Set data on the `key`-th trajectory of the dataset."
+        self._check_value(key, value)
+        self._discard(key)
+        self._arrays[key] = value
+        self._shapes[key] = value.shape
+        self._dtypes[key] = value.dtype
+        self.nbytes += value.nbytes
+        self._evict(keep=key)
+
+    def append(self, key, value):
+        "Append frames to the end of the `key`-th trajectory of the dataset."
+        if key not in self._shapes:
+            self[key] = value
+            return
+        self._check_value(key, value)
+        if value.shape[1:] != self._shapes[key][1:]:
+            raise ValueError('The shape of the frames in value, %s, does not '
+                             'match the shape of the frames already stored, %s'
+                             % (str(value.shape[1:]), str(self._shapes[key][1:])))
+        if key in self._arrays:
+            self._touch(key)
+            self._clean.discard(key)
+            old = self._arrays[key]
+            self._arrays[key] = np.concatenate([old, value.astype(old.dtype)])
+            self.nbytes += self._arrays[key].nbytes - old.nbytes
+        else:
+            self._spill.append(key, value.astype(self._dtypes[key]))
+        self._shapes[key] = (self._shapes[key][0] + len(value),) + self._shapes[key][1:]
+        self._evict(keep=key)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            trj_index, frame_index = key[0], key[1:]
+        else:
+            trj_index, frame_index = key, slice(None)
+        if not np.isscalar(trj_index) or trj_index != int(trj_index):
+            raise IndexError('first index must be an int')
+
+        if trj_index in self._arrays:
+            self._touch(trj_index)
+            return self._arrays[trj_index][frame_index]
+        if not isinstance(key, tuple) and trj_index in self._shapes:
+            # bring the whole trajectory back into memory. the copy on disk
+            # is left behind, so unless the trajectory is modified, it can
+            # be dropped again without being rewritten
+            value = self._spill[trj_index]
+            self._arrays[trj_index] = value
+            self._clean.add(trj_index)
+            self.nbytes += value.nbytes
+            self._evict(keep=trj_index)
+            return value
+        return self._get_array(trj_index)[frame_index]
+
+    def keys(self):
+        "Get the (sorted) list of the keys of the trajectories in the dataset"
+        return sorted(self._shapes)
+
+    def iter_chunks(self, chunk_size=10000, stride=1, lag=0, keys=None,
+                    columns=None, prefetch=0, prefetch_bytes=None):
+        """Iterate over the dataset in blocks of at most `chunk_size` frames.
+        See `DataSet.iter_chunks` for details."""
+        if chunk_size < 1 or stride < 1 or lag < 0:
+            raise ValueError('chunk_size and stride must be positive, and lag '
+                             'must be non-negative')
+        if keys is None:
+            keys = self.keys()
+
+        blocks = self._iter_chunks(chunk_size, stride, lag, keys, columns)
+        if prefetch > 0:
+            return _prefetch(blocks, prefetch, prefetch_bytes)
+        return blocks
+
+    def _iter_chunks(self, chunk_size, stride, lag, keys, columns):
+        for key in keys:
+            array = self._get_array(key)
+            n_frames = len(xrange(0, len(array), stride))
+            for start in xrange(0, n_frames - lag, chunk_size):
+                stop = min(start + chunk_size + lag, n_frames)
+                frames = slice(start*stride, stop*stride, stride)
+                if columns is None:
+                    yield key, start*stride, array[frames]
+                else:
+                    yield key, start*stride, _read_columns(array, columns, frames)
+
+    def set_trajfn(self, key, value):
+        self._row(key)
+        self._trajfns[key] = value
+
+    def get_trajfn(self, key):
+        self._row(key)
+        return self._trajfns.get(key, '')
+
+    def length(self, key):
+        """Get the length of a trajectory entry"""
+        return self._row(key)[0][0]
+
+    def shape(self, key):
+        """Get the shape of a trajectory entry"""
+        return self._row(key)[0]
+
+    def dtype(self, key):
+        """Get the dtype of a trajectory entry"""
+        return self._row(key)[1]
+
+    def lengths(self, keys=None):
+        """Get the lengths of many trajectory entries at once, by default
+        in the order of `keys()`"""
+        if keys is None:
+            keys = self.keys()
+        return np.array([self.length(key) for key in keys], dtype=np.int64)
+
+    def offsets(self):
+        """Get the CSR-style offsets of the trajectories, in the order of `keys()`"""
+        offsets = np.zeros(len(self._shapes) + 1, dtype=np.int64)
+        np.cumsum(self.lengths(), out=offsets[1:])
+        return offsets
+
+    def spilled_keys(self):
+        "Get the (sorted) list of the keys of the trajectories spilled to disk"
+        return sorted(set(self._shapes) - set(self._arrays))
+
+    @contextlib.contextmanager
+    def batch(self):
+        "For compatibility with `DataSet.batch`. There's nothing to defer."
+        yield self
+
+    def close(self):
+        "Drop every trajectory, and delete the temporary file"
+        self._arrays.clear()
+        self._clean.clear()
+        self._shapes.clear()
+        self._dtypes.clear()
+        self.nbytes = 0
+        if self._spill is not None:
+            self._spill.close()
+            os.unlink(self._spill_filename)
+            self._spill = None
+
+    def _get_array(self, key):
+        """Get the `key`-th trajectory: either a numpy array, or an array-like
+        object from the temporary DataSet"""
+        if key in self._arrays:
+            self._touch(key)
+            return self._arrays[key]
+        self._row(key)
+        return self._spill._get_array(key)
+
+    def _row(self, key):
+        "Get the shape and dtype of the `key`-th trajectory"
+        try:
+            return self._shapes[key], self._dtypes[key]
+        except KeyError:
+            raise KeyError(key)
+
+    def _touch(self, key):
+        "Mark the `key`-th trajectory as the most recently used"
+        self._arrays[key] = self._arrays.pop(key)
+
+    def _evict(self, keep):
+        """Spill the least recently used trajectories to disk until the rest
+        fit in the budget. `keep` is only spilled if it alone is too big."""
+        while self.nbytes > self.max_bytes and len(self._arrays) > 0:
+            key = next(iter(self._arrays))
+            if key == keep and len(self._arrays) > 1:
+                self._touch(key)
+                continue
+            if self._spill is None:
+                fd, self._spill_filename = tempfile.mkstemp(suffix='.h5', dir=self.spill_dir,
+                                                            prefix='msmb-spill-')
+                os.close(fd)
+                self._spill = DataSet(self._spill_filename, 'w', name='MemoryDataSet-spill',
+                                      compression='blosc:lz4', complevel=1, stats=False)
+            value = self._arrays.pop(key)
+            if key in self._clean:
+                self._clean.remove(key)
+            else:
+                self._spill[key] = value
+            self.nbytes -= value.nbytes
+
+    def _discard(self, key):
+        "Forget the in-memory data of the `key`-th trajectory"
+        self._clean.discard(key)
+        if key in self._arrays:
+            self.nbytes -= self._arrays.pop(key).nbytes
+
+    def _check_value(self, key, value):
+        if not np.isscalar(key) or key != int(key):
+            raise TypeError('key must be an int. You supplied %s of type %s'
+                            % (key, type(key)))
+        if not isinstance(value, np.ndarray):
+            raise TypeError('value must be a numpy array. You supplied %s of '
+                            'type %s' % (value, type(value)))
+        if value.ndim == 0:
+            raise ValueError('value must be at least one dimensional')
+
+    def __del__(self):
+        self.close()
+
+    def __str__(self):
+        return '<MemoryDataSet n_trajs=%(n_trajs)s, nbytes=%(nbytes)s, n_spilled=%(n_spilled)s>' \
+            % {'n_trajs': len(self._shapes), 'nbytes': self.nbytes,
+               'n_spilled': len(self.spilled_keys())}
+    def __repr__(self):
+        return str(self)
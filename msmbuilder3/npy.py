@@ -0,0 +1,224 @@
+"""Conversion between DataSets and directories of .npy files, which other
+tools can read (or memory-map) directly
+"""
+# stdlib
+import os
+import json
+import tempfile
+
+import numpy as np
+from numpy.lib.format import open_memmap
+from msmbuilder3.dataset import DataSet, UnrecognizedFormatError, _prefetch, _read_columns
+
+_format = 'msmbuilder-npy-dataset'
+_format_version = '1.0'
+_index_name = 'index.json'
+
+
+class NpyDataSet(object):
+    """Read-only access to a directory of .npy files written by `export_npy`
+
+    Each trajectory is stored in its own file, `<key>.npy`, and is returned
+    as a read-only `np.memmap`, so nothing is copied until the data is
+    used, and every process reading the directory shares the same pages of
+    the page cache. The keys and trajectory filenames are listed in
+    `index.json`.
+
+    Parameters
+    ----------
+    dirname : str
+        The directory written by `export_npy`
+    """
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        try:
+            with open(os.path.join(dirname, _index_name)) as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            raise UnrecognizedFormatError('%s is not an msmbuilder npy dataset' % dirname)
+        if not isinstance(index, dict) or index.get('format') != _format:
+            raise UnrecognizedFormatError('%s is not an msmbuilder npy dataset' % dirname)
+        if index.get('format_version') != _format_version:
+            raise UnrecognizedFormatError('only msmbuilder npy dataset version %s is '
+                                          'supported' % _format_version)
+
+        self.name = index.get('name')
+        self.timestep = index.get('timestep')
+        self._keys = sorted(int(key) for key in index['keys'])
+        self._trajfns = dict((int(key), fn) for key, fn in index['trajfns'].iteritems())
+        self._arrays = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            trj_index, frame_index = key[0], key[1:]
+        else:
+            trj_index, frame_index = key, slice(None)
+        if not np.isscalar(trj_index) or trj_index != int(trj_index):
+            raise IndexError('first index must be an int')
+        return self._get_array(trj_index)[frame_index]
+
+    def keys(self):
+        "Get the (sorted) list of the keys of the trajectories in the dataset"
+        return list(self._keys)
+
+    def iter_chunks(self, chunk_size=10000, stride=1, lag=0, keys=None,
+                    columns=None, prefetch=0, prefetch_bytes=None):
+        """Iterate over the dataset in blocks of at most `chunk_size` frames.
+        See `DataSet.iter_chunks` for details. The blocks are views of the
+        memory-mapped files."""
+        if chunk_size < 1 or stride < 1 or lag < 0:
+            raise ValueError('chunk_size and stride must be positive, and lag '
+                             'must be non-negative')
+        if keys is None:
+            keys = self.keys()
+
+        blocks = self._iter_chunks(chunk_size, stride, lag, keys, columns)
+        if prefetch > 0:
+            return _prefetch(blocks, prefetch, prefetch_bytes)
+        return blocks
+
+    def _iter_chunks(self, chunk_size, stride, lag, keys, columns):
+        for key in keys:
+            array = self._get_array(key)
+            n_frames = len(xrange(0, len(array), stride))
+            for start in xrange(0, n_frames - lag, chunk_size):
+                stop = min(start + chunk_size + lag, n_frames)
+                frames = slice(start*stride, stop*stride, stride)
+                if columns is None:
+                    yield key, start*stride, array[frames]
+                else:
+                    yield key, start*stride, _read_columns(array, columns, frames)
+
+    def get_trajfn(self, key):
+        self._get_array(key)
+        return self._trajfns.get(key, '')
+
+    def length(self, key):
+        """Get the length of a trajectory entry"""
+        return self._get_array(key).shape[0]
+
+    def shape(self, key):
+        """Get the shape of a trajectory entry"""
+        return self._get_array(key).shape
+
+    def dtype(self, key):
+        """Get the dtype of a trajectory entry"""
+        return self._get_array(key).dtype
+
+    def lengths(self, keys=None):
+        """Get the lengths of many trajectory entries at once, by default
+        in the order of `keys()`"""
+        if keys is None:
+            keys = self.keys()
+        return np.array([self.length(key) for key in keys], dtype=np.int64)
+
+    def offsets(self):
+        """Get the CSR-style offsets of the trajectories, in the order of `keys()`"""
+        offsets = np.zeros(len(self._keys) + 1, dtype=np.int64)
+        np.cumsum(self.lengths(), out=offsets[1:])
+        return offsets
+
+    def close(self):
+        "Drop the memory maps"
+        self._arrays = {}
+
+    def _get_array(self, key):
+        if key not in self._arrays:
+            if key not in self._keys:
+                raise KeyError(key)
+            filename = os.path.join(self.dirname, '%d.npy' % key)
+            self._arrays[key] = np.load(filename, mmap_mode='r')
+        return self._arrays[key]
+
+    def __str__(self):
+        return '<NpyDataSet dirname=%(dirname)s, n_trajs=%(n_trajs)s>' \
+            % {'dirname': self.dirname, 'n_trajs': len(self._keys)}
+    def __repr__(self):
+        return str(self)
+
+
+def export_npy(dataset, dirname, chunk_size=100000):
+    """Copy a DataSet into a directory of .npy files, one per trajectory,
+    which can then be opened with `NpyDataSet` or `np.load`
+
+    The trajectories are streamed in blocks of `chunk_size` frames straight
+    into memory-mapped output files, so neither a whole trajectory nor a
+    second copy of the dataset is ever held in memory.
+
+    Parameters
+    ----------
+    dataset : DataSet
+        The dataset to export (or any object with the same reading
+        interface, like `ShardedDataSet`)
+    dirname : str
+        The directory to write. It is created if it does not exist.
+    chunk_size : int
+        The number of frames copied at a time.
+    """
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    keys = dataset.keys()
+    for key in keys:
+        if dataset.length(key) == 0:
+            # empty arrays can't be memory-mapped, so they don't show up in
+            # iter_chunks anyway
+            np.save(os.path.join(dirname, '%d.npy' % key),
+                    np.empty(dataset.shape(key), dtype=dataset.dtype(key)))
+
+    out, out_key = None, None
+    for key, offset, data in dataset.iter_chunks(chunk_size, prefetch=2):
+        if key != out_key:
+            del out
+            out = open_memmap(os.path.join(dirname, '%d.npy' % key), mode='w+',
+                              dtype=dataset.dtype(key), shape=dataset.shape(key))
+            out_key = key
+        out[offset:offset+len(data)] = data
+    del out
+
+    index = {'format': _format, 'format_version': _format_version,
+             'name': getattr(dataset, 'name', None),
+             'timestep': getattr(dataset, 'timestep', None),
+             'keys': keys,
+             'trajfns': dict((str(key), dataset.get_trajfn(key)) for key in keys)}
+    fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.index')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(index, f, indent=2)
+    os.chmod(tmpname, 0o644)
+    os.rename(tmpname, os.path.join(dirname, _index_name))
+
+
+def import_npy(dirname, filename, chunk_size=100000, **kwargs):
+    """Copy a directory of .npy files written by `export_npy` into a new
+    DataSet, streaming in blocks of `chunk_size` frames.
+
+    Parameters
+    ----------
+    dirname : str
+        The directory to read
+    filename : str
+        The filename of the DataSet to write
+    chunk_size : int
+        The number of frames copied at a time.
+    **kwargs
+        Passed on to the `DataSet` (e.g. `compression`, `layout`)
+
+    Returns
+    -------
+    dataset : DataSet
+        The new DataSet, opened in mode 'w'
+    """
+    source = NpyDataSet(dirname)
+    dataset = DataSet(filename, 'w', name=source.name or 'dataset',
+                      timestep=source.timestep or 1, **kwargs)
+    with dataset.batch():
+        for key in source.keys():
+            if source.length(key) == 0:
+                dataset[key] = source[key]
+            for _, offset, data in source.iter_chunks(chunk_size, keys=[key]):
+                dataset.append(key, data)
+            if source.get_trajfn(key):
+                dataset.set_trajfn(key, source.get_trajfn(key))
+    source.close()
+    return dataset
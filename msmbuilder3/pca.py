@@ -1,7 +1,7 @@
 """Principle Component Analysis"""
 
 import numpy as np
-from base import BaseModeller, TransformerMixin, UpdateableEstimatorMixin
+from base import BaseModeller, TransformerMixin, UpdateableEstimatorMixin, float_dtype
 
 
 class PCA(BaseModeller, UpdateableEstimatorMixin, TransformerMixin):
@@ -97,6 +97,9 @@ class PCA(BaseModeller, UpdateableEstimatorMixin, TransformerMixin):
                 raise RuntimeError("data cannot be more than two-dimensional")
 
             n_features = row.shape[1]
+            # the running sums are accumulated in double precision, even if
+            # the data is single precision
+            row = np.asarray(row, dtype=np.float64)
 
             if self.running_corr_mat_ is None:
                 self.running_corr_mat_ = np.zeros((n_features, n_features))
@@ -176,7 +179,8 @@ class PCA(BaseModeller, UpdateableEstimatorMixin, TransformerMixin):
         Returns
         -------
         proj_X : np.ndarray or list of np.ndarray's
-            projected data
+            projected data, in the library-wide precision (see
+            `set_precision`)
 
         """
 
@@ -193,7 +197,8 @@ class PCA(BaseModeller, UpdateableEstimatorMixin, TransformerMixin):
             X = [X]
             return_list = False
 
-        top_pcs = self.eigenvectors_[:, :self.n_components]
+        dtype = float_dtype()
+        top_pcs = self.eigenvectors_[:, :self.n_components].astype(dtype)
 
         proj_X = []
         for row in X:
@@ -212,7 +217,7 @@ class PCA(BaseModeller, UpdateableEstimatorMixin, TransformerMixin):
             if n_features != top_pcs.shape[0]:
                 raise RuntimeError("data is not the right shape")
 
-            proj_X.append(row.dot(top_pcs))
+            proj_X.append(np.asarray(row, dtype=dtype).dot(top_pcs))
             # are you supposed to subtract the mean before projecting?
             # if so, then this is the correct line:
 
@@ -0,0 +1,220 @@
+"""Storage for data derived from mappings of molecular dynamics trajectories,
+spread over several PyTables files
+"""
+# stdlib
+import os
+import json
+import tempfile
+import contextlib
+
+import numpy as np
+from msmbuilder3.dataset import DataSet, UnrecognizedFormatError, _prefetch
+
+
+class ShardedDataSet(object):
+    """A DataSet whose trajectories are spread over several HDF5 files (shards)
+
+    The shards are ordinary `DataSet` files, and trajectory `key` always
+    lives in shard `key % n_shards`. They are tied together by a small JSON
+    manifest file, which is what gets opened. Since each shard is a separate
+    file, independent processes can each write one shard at the same time
+    (by opening the manifest with `shard=i`), and readers can open the
+    shards separately.
+
+    Parameters
+    ----------
+    filename : str
+        The filename of the manifest. The shards are stored next to it, as
+        `<filename without extension>.shard<i>.h5`.
+    mode : {'r', 'w', 'a'}
+        Open the dataset to read ('r'), write ('w') or append ('a'). In mode
+        'w', the manifest is (re)written.
+    n_shards : int
+        In mode == 'w', the number of shards. Otherwise, it is read from the
+        manifest.
+    shard : int, optional
+        Only open this one shard, instead of all of them. Only the
+        trajectories with `key % n_shards == shard` can then be read or
+        written. With mode='w', each writer process should use its own
+        shard; they may all (re)write the manifest, since its contents only
+        depend on `filename` and `n_shards`.
+    **kwargs
+        Passed on to the `DataSet` of each shard (e.g. `compression`,
+        `layout`).
+    """
+
+    # Identifies the manifest, and the version of its format
+    _format = 'msmbuilder-sharded-dataset'
+    _format_version = '1.0'
+
+    def __init__(self, filename, mode='r', n_shards=None, shard=None, **kwargs):
+        self.filename = filename
+        self.mode = mode
+        self._shards = {}
+
+        if not mode in ['r', 'w', 'a']:
+            raise ValueError("mode must be one of ['r', 'w', 'a']")
+        if mode == 'w':
+            if n_shards is None or n_shards < 1:
+                raise ValueError('n_shards must be a positive int in mode="w"')
+            self._write_manifest(filename, n_shards)
+        manifest = self._read_manifest(filename)
+        self.n_shards = manifest['n_shards']
+        if n_shards is not None and n_shards != self.n_shards:
+            raise ValueError('%s has %d shards, not %d' % (filename, self.n_shards, n_shards))
+        if shard is not None and not 0 <= shard < self.n_shards:
+            raise ValueError('shard must be between 0 and %d' % (self.n_shards - 1))
+
+        directory = os.path.dirname(os.path.abspath(filename))
+        self.shard_filenames = [os.path.join(directory, fn) for fn in manifest['shards']]
+        for i in range(self.n_shards) if shard is None else [shard]:
+            self._shards[i] = DataSet(self.shard_filenames[i], mode=mode, **kwargs)
+        self._key_map = None
+
+    def __setitem__(self, key, value):
+        "Set data on the `key`-th trajectory of the dataset."
+        self._shard(key)[key] = value
+        self._key_map = None
+
+    def append(self, key, value):
+        "Append frames to the end of the `key`-th trajectory of the dataset."
+        self._shard(key).append(key, value)
+        self._key_map = None
+
+    def __getitem__(self, key):
+        trj_index = key[0] if isinstance(key, tuple) else key
+        return self._shard(trj_index)[key]
+
+    def keys(self):
+        "Get the (sorted) list of the keys of the trajectories in the dataset"
+        return sorted(self._keys())
+
+    def iter_chunks(self, chunk_size=10000, stride=1, lag=0, keys=None,
+                    columns=None, prefetch=0, prefetch_bytes=None):
+        """Iterate over the dataset in blocks of at most `chunk_size` frames,
+        going through the trajectories in order of their keys. See
+        `DataSet.iter_chunks` for details.
+        """
+        if keys is None:
+            keys = self.keys()
+        for key in keys:
+            self._shard(key)._row(key)
+
+        blocks = self._iter_chunks(chunk_size, stride, lag, keys, columns)
+        if prefetch > 0:
+            return _prefetch(blocks, prefetch, prefetch_bytes)
+        return blocks
+
+    def _iter_chunks(self, chunk_size, stride, lag, keys, columns):
+        for key in keys:
+            for block in self._shard(key).iter_chunks(chunk_size, stride, lag, [key], columns):
+                yield block
+
+    def set_trajfn(self, key, value):
+        self._shard(key).set_trajfn(key, value)
+
+    def get_trajfn(self, key):
+        return self._shard(key).get_trajfn(key)
+
+    def length(self, key):
+        """Get the length of a trajectory entry"""
+        return self._shard(key).length(key)
+
+    def shape(self, key):
+        """Get the shape of a trajectory entry"""
+        return self._shard(key).shape(key)
+
+    def dtype(self, key):
+        """Get the dtype of a trajectory entry"""
+        return self._shard(key).dtype(key)
+
+    def lengths(self, keys=None):
+        """Get the lengths of many trajectory entries at once, by default
+        in the order of `keys()`"""
+        if keys is None:
+            keys = self.keys()
+        return np.array([self.length(key) for key in keys], dtype=np.int64)
+
+    def offsets(self):
+        """Get the CSR-style offsets of the trajectories, in the order of `keys()`"""
+        offsets = np.zeros(len(self._keys()) + 1, dtype=np.int64)
+        np.cumsum(self.lengths(), out=offsets[1:])
+        return offsets
+
+    @property
+    def provenance(self):
+        "The provenance of the first open shard"
+        return self._shards[min(self._shards)].provenance
+
+    @provenance.setter
+    def provenance(self, value):
+        for shard in self._shards.values():
+            shard.provenance = value
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Context manager that defers flushing data and index updates to
+        disk, in every open shard, until the end of the block."""
+        with contextlib.nested(*[shard.batch() for shard in self._shards.values()]):
+            yield self
+
+    def close(self):
+        "Close the HDF5 file handle of every shard"
+        for shard in self._shards.values():
+            shard.close()
+
+    def _keys(self):
+        """Get a dict mapping the key of every trajectory in the open shards
+        to the shard that holds it"""
+        if self._key_map is None:
+            self._key_map = {}
+            for i, shard in self._shards.iteritems():
+                for key in shard.keys():
+                    self._key_map[key] = i
+        return self._key_map
+
+    def _shard(self, key):
+        """Get the DataSet of the shard that (should) hold trajectory `key`"""
+        if int(key) != key:
+            raise IndexError('key must be an int')
+        i = int(key) % self.n_shards
+        if i not in self._shards:
+            raise KeyError('trajectory %d belongs to shard %d, which is not open'
+                           % (key, i))
+        return self._shards[i]
+
+    @classmethod
+    def _write_manifest(cls, filename, n_shards):
+        base = os.path.splitext(os.path.basename(filename))[0]
+        manifest = {'format': cls._format, 'format_version': cls._format_version,
+                    'n_shards': n_shards,
+                    'shards': ['%s.shard%d.h5' % (base, i) for i in range(n_shards)]}
+
+        # write to a temporary file and rename it into place, so that
+        # concurrent writers never leave a partial manifest behind
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, tmpname = tempfile.mkstemp(dir=directory, prefix='.manifest')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.chmod(tmpname, 0o644)
+        os.rename(tmpname, filename)
+
+    @classmethod
+    def _read_manifest(cls, filename):
+        with open(filename) as f:
+            try:
+                manifest = json.load(f)
+            except ValueError:
+                raise UnrecognizedFormatError('%s is not a sharded msmbuilder dataset' % filename)
+        if not isinstance(manifest, dict) or manifest.get('format') != cls._format:
+            raise UnrecognizedFormatError('%s is not a sharded msmbuilder dataset' % filename)
+        if manifest.get('format_version') != cls._format_version:
+            raise UnrecognizedFormatError('only sharded msmbuilder-dataset version %s is '
+                                          'supported' % cls._format_version)
+        return manifest
+
+    def __str__(self):
+        return '<ShardedDataSet filename=%(filename)s, n_shards=%(n_shards)s, n_trajs=%(n_trajs)s>' \
+            % {'filename': self.filename, 'n_shards': self.n_shards, 'n_trajs': len(self._keys())}
+    def __repr__(self):
+        return str(self)
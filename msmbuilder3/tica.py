@@ -2,7 +2,7 @@
 
 import numpy as np
 import scipy.linalg
-from base import BaseModeller, TransformerMixin, UpdateableEstimatorMixin
+from base import BaseModeller, TransformerMixin, UpdateableEstimatorMixin, float_dtype
 import logging
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -85,6 +85,9 @@ class tICA(BaseModeller, UpdateableEstimatorMixin, TransformerMixin):
                 raise RuntimeError("data cannot be more than two-dimensional")
 
             n_features = row.shape[1]
+            # the running sums are accumulated in double precision, even if
+            # the data is single precision
+            row = np.asarray(row, dtype=np.float64)
 
             if self.running_corr_mat_0_0_ is None:
                 self.running_corr_mat_0_0_ = np.zeros((n_features, n_features))
@@ -211,7 +214,8 @@ class tICA(BaseModeller, UpdateableEstimatorMixin, TransformerMixin):
         Returns
         -------
         proj_X : np.ndarray or list of np.ndarray's
-            projected data
+            projected data, in the library-wide precision (see
+            `set_precision`)
 
         """
 
@@ -228,7 +232,8 @@ class tICA(BaseModeller, UpdateableEstimatorMixin, TransformerMixin):
             X = [X]
             return_list = False
 
-        top_tics = self.vecs_[:, :self.n_components]
+        dtype = float_dtype()
+        top_tics = self.vecs_[:, :self.n_components].astype(dtype)
 
         proj_X = []
         for row in X:
@@ -247,7 +252,7 @@ class tICA(BaseModeller, UpdateableEstimatorMixin, TransformerMixin):
             if n_features != top_tics.shape[0]:
                 raise RuntimeError("data is not the right shape")
 
-            proj_X.append(row.dot(top_tics))
+            proj_X.append(np.asarray(row, dtype=dtype).dot(top_tics))
             # are you supposed to subtract the mean before projecting?
             # if so, then this is the correct line:
 
@@ -2,7 +2,7 @@
 
 import numpy as np
 import mdtraj as md
-from .base import BaseModeller, TransformerMixin
+from .base import BaseModeller, TransformerMixin, float_dtype
 
 
 class PositionVectorizer(BaseModeller, TransformerMixin):
@@ -24,7 +24,17 @@ class PositionVectorizer(BaseModeller, TransformerMixin):
         both `reference` and `alignment_indices` are none, no alignment
         will be done, and the cartesian coordinates of the trajectories
         will be used *as is*.
+
+    Notes
+    -----
+    The frames are aligned in blocks of `_block_size` frames at a time, with
+    the Kabsch algorithm: the 3x3 covariance matrices between the (centered)
+    alignment atoms and the (centered) reference of every frame in a block
+    are computed with a single matrix product, and the optimal rotations are
+    found with one batched SVD.
     """
+    # Number of frames aligned at once
+    _block_size = 4096
 
     def __init__(self, reference=None, alignment_indices=slice(None)):
         self.alignment_indices = alignment_indices
@@ -34,9 +44,7 @@ class PositionVectorizer(BaseModeller, TransformerMixin):
     def _target(self):
         """_target is the cartesian coordinates of the alignment
         atoms of the first frame of the reference trajectory."""
-        if not hasattr(self, '__target') or not self.__target:
-            self.__target = self.reference.xyz[0, self.alignment_indices]
-        return self.__target
+        return self.reference.xyz[0, self.alignment_indices]
 
     def transform(self, X):
         """
@@ -53,18 +61,31 @@ class PositionVectorizer(BaseModeller, TransformerMixin):
         X_new : numpy array of shape [n_frames, n_atoms*3]
             `X_new[i, 3*j+d]` will contain the cartesian coordinate of the
             `i`-th frame in the `d`th dimension (x, y or z) after alignment.
+            Each frame is rotated and translated as a whole, so that its
+            alignment atoms are superposed on those of the reference. The
+            dtype follows the library-wide precision (see `set_precision`).
         """
         if isinstance(X, list):
             return map(self._transform, X)
         return self._transform(X)
 
     def _transform(self, X):
-        # This can be probably done more efficiently in C
-        X_new = np.empty((X.n_frames, X.n_atoms*3))
-        for i in range(X.n_frames):
-            X_new[i] = md.geometry.alignment.transform(X.xyz[i, self.alignment_indices], self._target).reshape(-1)
+        dtype = float_dtype()
+        X_new = np.empty((X.n_frames, X.n_atoms, 3), dtype=dtype)
+        if self.reference is None:
+            X_new[:] = X.xyz
+            return X_new.reshape(X.n_frames, X.n_atoms*3)
+
+        target = np.asarray(self._target, dtype=np.float64)
+        target_center = target.mean(axis=0)
+        target = (target - target_center).astype(dtype)
 
-        return X_new
+        for start in range(0, X.n_frames, self._block_size):
+            xyz = np.asarray(X.xyz[start:start+self._block_size], dtype=dtype)
+            X_new[start:start+len(xyz)] = _kabsch_align(
+                xyz, xyz[:, self.alignment_indices], target) + target_center
+
+        return X_new.reshape(X.n_frames, X.n_atoms*3)
 
     def inverse_transform(self, X):
         """
@@ -93,6 +114,38 @@ class PositionVectorizer(BaseModeller, TransformerMixin):
                              'must be an multiple of 3')
         return md.Trajectory(X.reshape((X.shape[0], X.shape[1]/3, 3)), topology=None)
 
+def _kabsch_align(xyz, mobile, target):
+    """Rotate and center every frame in `xyz` so that its atoms `mobile`
+    are optimally superposed on the centered coordinates `target`
+
+    Parameters
+    ----------
+    xyz : np.ndarray, shape=[n_frames, n_atoms, 3]
+    mobile : np.ndarray, shape=[n_frames, n_alignment_atoms, 3]
+    target : np.ndarray, shape=[n_alignment_atoms, 3]
+        Centered at the origin.
+
+    Returns
+    -------
+    aligned : np.ndarray, shape=[n_frames, n_atoms, 3]
+    """
+    n_frames, n_mobile = mobile.shape[:2]
+    centers = mobile.mean(axis=1)
+    mobile = mobile - centers[:, np.newaxis]
+
+    # all of the covariance matrices, H[i] = mobile[i].T . target, in one
+    # matrix product
+    H = np.dot(mobile.transpose(0, 2, 1).reshape(n_frames*3, n_mobile), target)
+    H = H.reshape(n_frames, 3, 3).astype(np.float64)
+    U, S, Vt = np.linalg.svd(H)
+    # flip the last singular vector where needed to get proper rotations,
+    # not reflections
+    U[:, :, 2] *= np.sign(np.linalg.det(U) * np.linalg.det(Vt))[:, np.newaxis]
+    R = np.einsum('nij,njk->nik', U, Vt).astype(xyz.dtype)
+
+    return np.einsum('nai,nij->naj', xyz - centers[:, np.newaxis], R)
+
+
 class DistanceVectorizer(BaseModeller, TransformerMixin):
     """
     Transform a molecular dynamics trajectory into a multvariate 
@@ -139,7 +192,8 @@ class DistanceVectorizer(BaseModeller, TransformerMixin):
         return self._transform(X)
 
     def _transform(self, X):
-        return md.geometry.compute_distances(X, self.pair_indices, self.periodic)
+        return np.asarray(md.geometry.compute_distances(X, self.pair_indices, self.periodic),
+                          dtype=float_dtype())
 
 
 class AngleVectorizer(BaseModeller, TransformerMixin):
@@ -188,7 +242,8 @@ class AngleVectorizer(BaseModeller, TransformerMixin):
         return self._transform(X)
     
     def _transform(self, X):
-        return md.geometry.compute_angles(X, self.triplet_indices)
+        return np.asarray(md.geometry.compute_angles(X, self.triplet_indices),
+                          dtype=float_dtype())
 
 
 class DihedralVectorizer(BaseModeller, TransformerMixin):
@@ -238,4 +293,5 @@ class DihedralVectorizer(BaseModeller, TransformerMixin):
         return self._transform(X)
 
     def _transform(self, X):
-        return md.geometry.compute_dihedrals(X, self.quartet_indices)
+        return np.asarray(md.geometry.compute_dihedrals(X, self.quartet_indices),
+                          dtype=float_dtype())
@@ -0,0 +1,186 @@
+"""A process that owns a DataSet, and writes the arrays sent to it by any
+number of producer processes
+"""
+# stdlib
+import os
+import Queue
+import tempfile
+import traceback
+import multiprocessing
+
+import numpy as np
+from msmbuilder3.dataset import DataSet
+
+
+class DataSetWriter(object):
+    """Write to a DataSet from many processes at once
+
+    HDF5 files can't be written safely from more than one process, so the
+    `DataSet` is owned by a single writer process, started when the
+    `DataSetWriter` is created. Producer processes hand it their
+    trajectories with `put`, through a bounded queue: when the writer falls
+    behind, `put` blocks until there is room, so the producers can't run
+    away with all of the memory. Large arrays are not pickled through the
+    queue. Instead, they are saved to a file in shared memory (`/dev/shm`,
+    where available) and only the filename is sent.
+
+    The writer commits the index to disk every `batch_size` trajectories
+    (see `DataSet.batch`), or whenever it has been idle for
+    `commit_interval` seconds.
+
+    The `DataSetWriter` must be created before the producer processes, so
+    that they inherit it (for example, as an argument to
+    `multiprocessing.Process`, or through the `initializer` of a
+    `multiprocessing.Pool`).
+
+    Parameters
+    ----------
+    filename : str
+        The filename of the DataSet
+    mode : {'w', 'a'}
+        The mode in which the DataSet is opened
+    max_pending : int
+        The largest number of trajectories waiting in the queue.
+    batch_size : int
+        The largest number of trajectories written between commits.
+    commit_interval : float
+        Commit after this many seconds without receiving anything.
+    shm_threshold : int
+        Hand off arrays of at least this many bytes through shared memory.
+    **kwargs
+        Passed on to the `DataSet`.
+
+    Examples
+    --------
+    >>> writer = DataSetWriter('output.h5')
+    >>> def work(i):
+    ...     writer.put(i, np.random.randn(100, 3), trajfn='traj%d.xtc' % i)
+    >>> workers = [multiprocessing.Process(target=work, args=(i,)) for i in range(4)]
+    >>> for p in workers: p.start()
+    >>> for p in workers: p.join()
+    >>> writer.close()
+    """
+
+    def __init__(self, filename, mode='w', max_pending=8, batch_size=64,
+                 commit_interval=5.0, shm_threshold=2**20, **kwargs):
+        if not mode in ['w', 'a']:
+            raise ValueError("mode must be one of ['w', 'a']")
+        self.filename = filename
+        self.shm_threshold = shm_threshold
+        self._shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        self._queue = multiprocessing.Queue(maxsize=max_pending)
+        self._errors = multiprocessing.Queue()
+        self._process = multiprocessing.Process(
+            target=_write_loop, name='DataSetWriter',
+            args=(filename, mode, kwargs, self._queue, self._errors,
+                  batch_size, commit_interval))
+        self._process.daemon = True
+        self._process.start()
+
+    def put(self, key, value, trajfn=None, source=None, append=False):
+        """Send an array to be written to (or, with append=True, appended to)
+        the `key`-th trajectory of the DataSet. This blocks while the queue
+        is full.
+
+        Parameters
+        ----------
+        key : int
+            The index of the trajectory
+        value : np.ndarray
+            The data
+        trajfn : str, optional
+            If given, recorded with `DataSet.set_trajfn`.
+        source : str or tuple, optional
+            If given, recorded with `DataSet.record_source`: either the
+            filename, or a tuple of (filename, mtime, size).
+        append : bool
+            Append to the trajectory instead of replacing it.
+        """
+        if self._process is None:
+            raise ValueError('this DataSetWriter is closed')
+        value = np.asarray(value)
+        payload = value
+        if value.nbytes >= self.shm_threshold:
+            fd, payload = tempfile.mkstemp(suffix='.npy', dir=self._shm_dir,
+                                           prefix='msmb-writer-')
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, value)
+        self._queue.put((key, payload, trajfn, source, append))
+
+    def close(self):
+        """Wait for everything that has been sent to be written, and close
+        the DataSet. Raises a RuntimeError if the writer failed."""
+        if self._process is None:
+            return
+        self._queue.put(None)
+        self._process.join()
+        self._process = None
+
+        try:
+            error = self._errors.get(timeout=1)
+        except Queue.Empty:
+            return
+        raise RuntimeError('writing to %s failed:\n%s' % (self.filename, error))
+
+
+def _write_loop(filename, mode, kwargs, queue, errors, batch_size, commit_interval):
+    "The main loop of the writer process"
+    dataset, failed, done = None, False, False
+    try:
+        dataset = DataSet(filename, mode, **kwargs)
+        while not done:
+            with dataset.batch():
+                for i in range(batch_size):
+                    try:
+                        item = queue.get(timeout=commit_interval)
+                    except Queue.Empty:
+                        break
+                    if item is None:
+                        done = True
+                        break
+                    _write_item(dataset, *item)
+        dataset.close()
+    except Exception:
+        errors.put(traceback.format_exc())
+        failed = True
+
+    # keep draining the queue, so that the producers never block on a dead
+    # writer, until the sentinel arrives
+    while failed and not done:
+        item = queue.get()
+        if item is None:
+            break
+        if isinstance(item[1], basestring):
+            os.unlink(item[1])
+    if failed and dataset is not None:
+        try:
+            dataset.close()
+        except Exception:
+            pass
+
+
+def _write_item(dataset, key, payload, trajfn, source, append):
+    if isinstance(payload, basestring):
+        # handed off through shared memory
+        try:
+            value = np.load(payload, mmap_mode='r')
+            _write_value(dataset, key, value, append)
+            del value
+        finally:
+            os.unlink(payload)
+    else:
+        _write_value(dataset, key, payload, append)
+
+    if trajfn is not None:
+        dataset.set_trajfn(key, trajfn)
+    if isinstance(source, tuple):
+        dataset.record_source(key, *source)
+    elif source is not None:
+        dataset.record_source(key, source)
+
+
+def _write_value(dataset, key, value, append):
+    if append:
+        dataset.append(key, value)
+    else:
+        dataset[key] = value
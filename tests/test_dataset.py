@@ -0,0 +1,456 @@
+import os
+import tempfile
+import numpy as np
+import tables
+from msmbuilder3 import DataSet
+from msmbuilder3.dataset import tune_compression
+
+
+fn = None
+def setup():
+    global fn
+    fn = tempfile.mkstemp()[1]
+
+def teardown():
+    os.unlink(fn)
+
+
+def test_setitem_getitem():
+    a = np.random.randn(10, 3)
+    b = np.random.randn(5, 3)
+
+    ds = DataSet(fn, 'w')
+    ds[0] = a
+    ds[1] = b
+    ds.close()
+
+    ds = DataSet(fn)
+    np.testing.assert_array_equal(ds[0], a)
+    np.testing.assert_array_equal(ds[1, 2], b[2])
+    assert sorted(ds.keys()) == [0, 1]
+    assert ds.length(0) == 10
+    ds.close()
+
+
+def test_overwrite_different_shape():
+    ds = DataSet(fn, 'w')
+    ds[0] = np.random.randn(10, 3)
+    b = np.random.randn(7, 2).astype(np.float32)
+    ds[0] = b
+    np.testing.assert_array_equal(ds[0], b)
+    ds.close()
+
+
+def test_append():
+    a = np.random.randn(25, 4).astype(np.float32)
+
+    ds = DataSet(fn, 'w', chunkshape=8)
+    for i in range(0, len(a), 10):
+        ds.append(0, a[i:i+10])
+    assert ds._handle.get_node(ds._data, '0').chunkshape == (8, 4)
+    ds.close()
+
+    ds = DataSet(fn)
+    np.testing.assert_array_equal(ds[0], a)
+    assert ds.keys() == [0]
+    ds.close()
+
+
+def test_iter_chunks():
+    a = np.random.randn(25, 2)
+    b = np.random.randn(3, 2)
+
+    ds = DataSet(fn, 'w')
+    ds[0] = a
+    ds[1] = b
+
+    chunks = list(ds.iter_chunks(chunk_size=10))
+    assert [(k, o, len(d)) for k, o, d in chunks] == [(0, 0, 10), (0, 10, 10), (0, 20, 5), (1, 0, 3)]
+    np.testing.assert_array_equal(np.concatenate([d for k, o, d in chunks[:3]]), a)
+
+    chunks = list(ds.iter_chunks(chunk_size=4, stride=2))
+    np.testing.assert_array_equal(np.concatenate([d for k, o, d in chunks if k == 0]), a[::2])
+    assert [o for k, o, d in chunks if k == 0] == [0, 8, 16, 24]
+
+    # every time-lagged pair appears in exactly one block
+    lag = 3
+    pairs = []
+    for k, o, d in ds.iter_chunks(chunk_size=4, lag=lag):
+        pairs.extend((k, o + i) for i in range(len(d) - lag))
+    assert pairs == [(0, i) for i in range(len(a) - lag)]
+    ds.close()
+
+
+def test_mmap():
+    a = np.random.randn(10, 3).astype(np.float32)
+    b = np.arange(7)
+
+    ds = DataSet(fn, 'w', compression=None)
+    ds[0] = a
+    ds[1] = b
+    ds.close()
+
+    try:
+        ds = DataSet(fn, mmap=True)
+        assert isinstance(ds[0], np.memmap)
+        np.testing.assert_array_equal(ds[0], a)
+        np.testing.assert_array_equal(ds[1, 2:5], b[2:5])
+        assert ds.length(1) == 7
+        ds.close()
+    finally:
+        os.unlink(fn + '.mmap')
+
+
+def test_index_metadata():
+    ds = DataSet(fn, 'w')
+    ds[2] = np.zeros((4, 3, 2), dtype=np.float32)
+    ds[0] = np.zeros(7, dtype=np.int32)
+    ds.append(0, np.zeros(3, dtype=np.int32))
+    ds.set_trajfn(2, 'two.xtc')
+    ds.close()
+
+    ds = DataSet(fn)
+    assert ds.keys() == [0, 2]
+    assert ds.shape(2) == (4, 3, 2)
+    assert ds.shape(0) == (10,)
+    assert ds.dtype(2) == np.float32
+    assert ds.dtype(0) == np.int32
+    np.testing.assert_array_equal(ds.lengths(), [10, 4])
+    assert ds.get_trajfn(2) == 'two.xtc'
+    ds.close()
+
+
+def test_flat_layout():
+    a = np.random.randn(10, 3)
+    b = np.random.randn(4, 3)
+
+    ds = DataSet(fn, 'w', layout='flat')
+    ds[0] = a
+    ds.append(1, b[:2])
+    ds.append(1, b[2:])
+    a = a + 1
+    ds[0] = a
+    ds.close()
+
+    ds = DataSet(fn)
+    assert ds.layout == 'flat'
+    assert ds.keys() == [0, 1]
+    np.testing.assert_array_equal(ds[0], a)
+    np.testing.assert_array_equal(ds[1], b)
+    np.testing.assert_array_equal(ds[1, -1], b[-1])
+    np.testing.assert_array_equal(ds[1, ::-2], b[::-2])
+    np.testing.assert_array_equal(ds[1, [0, 2], 1], b[[0, 2], 1])
+    np.testing.assert_array_equal(ds.offsets(), [0, 10, 14])
+    np.testing.assert_array_equal(ds.flat(), np.concatenate([a, b]))
+    ds.close()
+
+
+def test_flat_nodes_layout():
+    a = np.random.randn(10, 3)
+    b = np.random.randn(4, 3)
+
+    ds = DataSet(fn, 'w')
+    ds[3] = b
+    ds[1] = a
+    np.testing.assert_array_equal(ds.offsets(), [0, 10, 14])
+    np.testing.assert_array_equal(ds.flat(), np.concatenate([a, b]))
+    ds.close()
+
+
+def test_take():
+    a = np.random.randn(300, 2)
+    b = np.random.randn(20, 2)
+    X = np.concatenate([a, b])
+    indices = [310, 0, 5, 299, 5, 200, 301]
+
+    for layout in ['nodes', 'flat']:
+        ds = DataSet(fn, 'w', layout=layout)
+        ds[0] = a
+        ds[1] = b
+        np.testing.assert_array_equal(ds.take(indices), X[indices])
+        assert ds.take([]).shape == (0, 2)
+        ds.close()
+
+
+def test_batch():
+    ds = DataSet(fn, 'w')
+    try:
+        with ds.batch():
+            for i in range(20):
+                ds[i] = np.arange(i)
+                ds.set_trajfn(i, 'traj%d' % i)
+            ds.append(0, np.arange(3))
+            assert ds._index.nrows == 0
+            assert ds.get_trajfn(3) == 'traj3'
+            raise RuntimeError()
+    except RuntimeError:
+        pass
+    # committed even though the batch raised
+    assert ds._index.nrows == 20
+    ds.close()
+
+    ds = DataSet(fn)
+    assert ds.keys() == range(20)
+    assert ds.length(0) == 3
+    assert ds.get_trajfn(19) == 'traj19'
+    np.testing.assert_array_equal(ds[7], np.arange(7))
+    ds.close()
+
+
+def test_append_mode():
+    source = tempfile.mkstemp()[1]
+    try:
+        ds = DataSet(fn, 'w')
+        ds[0] = np.arange(5)
+        ds.record_source(0, source)
+        ds.close()
+
+        ds = DataSet(fn, 'a')
+        assert ds.is_processed(source)
+        assert ds.sources()[os.path.abspath(source)][0] == 0
+        ds[1] = np.arange(3)
+        ds.close()
+
+        with open(source, 'w') as f:
+            f.write('modified')
+
+        ds = DataSet(fn)
+        assert ds.keys() == [0, 1]
+        assert not ds.is_processed(source)
+        assert len(ds.provenance) == 2
+        ds.close()
+    finally:
+        os.unlink(source)
+
+
+def test_stats():
+    a = np.random.randn(30, 3)
+    b = np.random.randn(7, 3) + 5
+
+    ds = DataSet(fn, 'w')
+    for i in range(0, len(a), 8):
+        ds.append(0, a[i:i+8])
+    ds[1] = b
+    ds.close()
+
+    X = np.concatenate([a, b])
+    ds = DataSet(fn)
+    stats = ds.stats
+    assert stats['count'] == len(X)
+    np.testing.assert_array_almost_equal(stats['mean'], X.mean(axis=0))
+    np.testing.assert_array_almost_equal(stats['var'], X.var(axis=0))
+    np.testing.assert_array_equal(stats['min'], X.min(axis=0))
+    np.testing.assert_array_equal(stats['max'], X.max(axis=0))
+    ds.close()
+
+    # merged with the stored statistics in append mode
+    c = np.random.randn(4, 3)
+    ds = DataSet(fn, 'a')
+    ds[2] = c
+    ds.close()
+    X = np.concatenate([X, c])
+    ds = DataSet(fn)
+    np.testing.assert_array_almost_equal(ds.stats['var'], X.var(axis=0))
+    ds.close()
+
+    # overwriting a trajectory forces a recompute on close
+    ds = DataSet(fn, 'a')
+    ds[1] = np.zeros((2, 3))
+    assert ds.stats is None
+    ds.close()
+    X = np.concatenate([a, np.zeros((2, 3)), c])
+    ds = DataSet(fn)
+    assert ds.stats['count'] == len(X)
+    np.testing.assert_array_almost_equal(ds.stats['mean'], X.mean(axis=0))
+    ds.close()
+
+
+def test_stats_not_recomputed():
+    def fail(*args, **kwargs):
+        raise AssertionError('the statistics should not be recomputed')
+
+    # frames with different numbers of features can't be summarized together
+    ds = DataSet(fn, 'w')
+    ds[0] = np.random.randn(5, 3)
+    ds[1] = np.random.randn(5, 2)
+    ds.close()
+    ds = DataSet(fn, 'a')
+    assert ds.stats is None
+    ds.iter_chunks = fail
+    ds.append(1, np.random.randn(2, 2))
+    ds.close()
+
+    # a file without statistics, opened in append mode but not modified
+    ds = DataSet(fn, 'w')
+    ds[0] = np.random.randn(5, 3)
+    ds.close()
+    with tables.open_file(fn, 'a') as f:
+        del f.root._v_attrs.stats_count
+    ds = DataSet(fn, 'a')
+    assert ds.stats is None
+    ds.iter_chunks = fail
+    ds.close()
+    ds = DataSet(fn)
+    assert ds.stats is None
+    ds.close()
+
+
+def test_prefetch():
+    ds = DataSet(fn, 'w')
+    for i in range(5):
+        ds[i] = np.random.randn(50, 4)
+
+    expected = list(ds.iter_chunks(chunk_size=7, lag=2))
+    for kwargs in [{'prefetch': 1}, {'prefetch': 4, 'prefetch_bytes': 100}]:
+        chunks = list(ds.iter_chunks(chunk_size=7, lag=2, **kwargs))
+        assert [(k, o) for k, o, d in chunks] == [(k, o) for k, o, d in expected]
+        for (k, o, d), (_, _, e) in zip(chunks, expected):
+            np.testing.assert_array_equal(d, e)
+
+    # stopping early shuts down the reader thread
+    chunks = ds.iter_chunks(chunk_size=7, prefetch=2)
+    next(chunks)
+    chunks.close()
+
+    # errors on the reader thread are raised in the caller
+    try:
+        list(ds.iter_chunks(chunk_size=7, keys=[0, 10], prefetch=2))
+    except KeyError:
+        pass
+    else:
+        raise AssertionError('expected KeyError')
+
+    # the dataset can be read and written on the main thread while the
+    # reader thread is running
+    for k, o, d in ds.iter_chunks(chunk_size=7, keys=[0, 1, 2], prefetch=2):
+        np.testing.assert_array_equal(d, ds[k, o:o+7])
+        with ds.batch():
+            ds[k + 10] = d
+            ds.set_trajfn(k + 10, 'traj%d.xtc' % k)
+    assert ds.get_trajfn(10) == 'traj0.xtc'
+    np.testing.assert_array_equal(ds[12], ds[2, 49:])
+    ds.close()
+
+
+def test_compression_options():
+    a = np.arange(300, dtype=np.float32).reshape(100, 3)
+    ds = DataSet(fn, 'w', compression='blosc:lz4', complevel=5, shuffle='bit')
+    ds[0] = a
+    filters = ds._handle.get_node(ds._data, '0').filters
+    assert filters.complib == 'blosc:lz4'
+    assert filters.complevel == 5
+    assert filters.bitshuffle and not filters.shuffle
+    ds.close()
+
+    ds = DataSet(fn)
+    np.testing.assert_array_equal(ds[0], a)
+
+    results = tune_compression(ds, target='ratio', candidates=[
+        {'compression': None}, {'compression': 'zlib', 'complevel': 9}])
+    assert [r['options']['compression'] for r in results] == ['zlib', None]
+    assert results[0]['ratio'] > 1
+    assert len(tune_compression(ds, n_samples=1)) > 2
+    ds.close()
+
+
+def test_encoding():
+    a = np.repeat([3, 3, 1, 7, 2], [10, 5, 1, 20, 4]).astype(np.int32)
+    b = np.array([[1, 2], [3, 4], [-5, 6]], dtype=np.int64)
+    c = np.random.randn(5, 2)
+
+    ds = DataSet(fn, 'w', encoding='rle')
+    ds.append(0, a[:12])
+    ds.append(0, a[12:])
+    ds[1] = b
+    ds[2] = c
+    # both runs of 3 were merged into one
+    runs = ds._handle.get_node(ds._data, '0')
+    assert runs.shape == (4, 2) and runs.dtype == np.uint8
+    assert ds._handle.get_node(ds._data, '1').dtype == np.int8
+    # appending values that don't fit in uint8 widens the stored dtype
+    ds.append(0, np.array([1000, 1000, 3], dtype=np.int32))
+    a = np.concatenate([a, [1000, 1000, 3]])
+    ds.close()
+
+    ds = DataSet(fn)
+    assert ds.dtype(0) == np.int32 and ds.shape(0) == a.shape
+    np.testing.assert_array_equal(ds[0], a)
+    assert ds[0].dtype == np.int32
+    assert ds[0, 12] == a[12] and ds[0, -1] == a[-1]
+    np.testing.assert_array_equal(ds[0, 3:30:4], a[3:30:4])
+    np.testing.assert_array_equal(ds[0, ::-3], a[::-3])
+    np.testing.assert_array_equal(ds[0, [16, 0, -1]], a[[16, 0, -1]])
+    np.testing.assert_array_equal(ds[1], b)
+    np.testing.assert_array_equal(ds[2], c)
+    np.testing.assert_array_equal(ds.take([40, 2, 15]), a[[40, 2, 15]])
+    np.testing.assert_array_equal(
+        np.concatenate([d for k, o, d in ds.iter_chunks(chunk_size=7, keys=[0])]), a)
+
+    key, values, lengths = next(ds.iter_runs(keys=[0]))
+    np.testing.assert_array_equal(values, [3, 1, 7, 2, 1000, 3])
+    np.testing.assert_array_equal(lengths, [15, 1, 20, 4, 2, 1])
+    ds.close()
+
+
+def test_pyramid():
+    a = np.random.randn(253, 2)
+
+    ds = DataSet(fn, 'w', pyramid=(10, 3))
+    for i in range(0, len(a), 17):
+        ds.append(0, a[i:i+17])
+    ds.close()
+
+    ds = DataSet(fn, 'a')
+    assert ds.pyramid == [3, 10]
+    ds.append(0, a[:5])
+    a = np.concatenate([a, a[:5]])
+    ds.close()
+
+    ds = DataSet(fn)
+    assert ds._pyramid_level(0, 20)[1] == 10
+    assert ds._pyramid_level(0, 9)[1] == 3
+    assert ds._pyramid_level(0, 20, start=5)[1] == 1
+    for index in [slice(None, None, 10), slice(30, 200, 20), slice(6, 7, 3),
+                  slice(9, None, 6), slice(5, 100, 10), slice(None, None, 7)]:
+        np.testing.assert_array_equal(ds[0, index], a[index])
+    np.testing.assert_array_equal(ds[0, ::30, 1], a[::30, 1])
+
+    chunks = list(ds.iter_chunks(chunk_size=4, stride=30))
+    np.testing.assert_array_equal(np.concatenate([d for k, o, d in chunks]), a[::30])
+    assert [o for k, o, d in chunks] == [0, 120, 240]
+    assert ds[0, ::10].dtype == ds[0].dtype
+    ds.close()
+
+    # in the flat layout, frames are cast into the dtype of the stored array,
+    # and the pyramid levels have to match it
+    ds = DataSet(fn, 'w', layout='flat', pyramid=(10,))
+    ds[0] = a
+    ds[1] = a[:100].astype(np.float32)
+    ds.close()
+
+    ds = DataSet(fn)
+    assert ds._pyramid_level(1, 10)[1] == 10
+    assert ds[1, ::10].dtype == ds[1].dtype == np.float64
+    np.testing.assert_array_equal(ds[1, ::10], a[:100:10].astype(np.float32))
+    ds.close()
+
+
+def test_read_columns():
+    a = np.random.randn(300, 50)
+    columns = [7, 3, 3, 40, -1, 8]
+
+    for layout in ['nodes', 'flat']:
+        ds = DataSet(fn, 'w', layout=layout, column_block=4, pyramid=(10,))
+        ds[0] = a
+        array = ds._handle.get_node(ds._data, 'frames' if layout == 'flat' else '0')
+        assert array.chunkshape[1] == 4
+        ds.close()
+
+        ds = DataSet(fn)
+        np.testing.assert_array_equal(ds.read_columns(0, columns), a[:, columns])
+        np.testing.assert_array_equal(ds.read_columns(0, columns, 5, 200, 3), a[5:200:3, columns])
+        np.testing.assert_array_equal(ds.read_columns(0, columns, step=20), a[::20, columns])
+        assert ds.read_columns(0, []).shape == (300, 0)
+        chunks = list(ds.iter_chunks(chunk_size=64, columns=[2, 1]))
+        np.testing.assert_array_equal(np.concatenate([d for k, o, d in chunks]), a[:, [2, 1]])
+        ds.close()
@@ -6,4 +6,14 @@ def test_kcenters_1():
     k = KCenters(10).fit(data)
     
     np.testing.assert_array_equal(k.labels_, k.predict(data))
-    np.testing.assert_array_equal(k.labels_[k.center_indices_], np.arange(10))
\ No newline at end of file
+    np.testing.assert_array_equal(k.labels_[k.center_indices_], np.arange(10))
+
+def test_kcenters_precision():
+    data = np.random.randn(100, 4)
+    k = KCenters(10, precision='double').fit(data)
+    assert k.centers_.dtype == np.float64
+    np.testing.assert_array_equal(k.labels_, k.transform(data))
+
+    # single precision is the default
+    k = KCenters(10).fit(data)
+    assert k.centers_.dtype == np.float32
@@ -0,0 +1,74 @@
+import shutil
+import tempfile
+import threading
+import numpy as np
+from msmbuilder3 import LiveDataSet
+
+
+dirname = None
+def setup():
+    global dirname
+    dirname = tempfile.mkdtemp()
+
+def teardown():
+    shutil.rmtree(dirname)
+
+
+def test_live():
+    writer = LiveDataSet(dirname, 'w', segment_size=2)
+    reader = LiveDataSet(dirname)
+    assert reader.keys() == []
+
+    a = np.random.randn(10, 3)
+    writer[0] = a
+    writer.set_trajfn(0, 'zero.xtc')
+    writer.append(1, a[:4])
+    writer.append(1, a[4:])
+    # nothing is published until the segment is full and a new trajectory
+    # is started
+    assert reader.refresh() == []
+    writer[2] = a[:3]
+    assert reader.refresh() == [0, 1]
+    np.testing.assert_array_equal(reader[1], a)
+    assert reader.get_trajfn(0) == 'zero.xtc'
+    assert not reader.closed
+
+    writer[0] = a[:1]
+    writer.close()
+    assert list(reader.follow(timeout=0)) == [0, 1, 2, 0]
+    assert reader.closed
+    assert reader.keys() == [0, 1, 2]
+    np.testing.assert_array_equal(reader[0], a[:1])
+    np.testing.assert_array_equal(reader.lengths(), [1, 10, 3])
+    reader.close()
+
+    writer = LiveDataSet(dirname, 'a')
+    writer[3] = a
+    writer.close()
+    reader = LiveDataSet(dirname)
+    assert reader.keys() == [0, 1, 2, 3]
+    chunks = list(reader.iter_chunks(chunk_size=4, keys=[3, 1]))
+    assert [(k, o) for k, o, d in chunks] == [(3, 0), (3, 4), (3, 8), (1, 0), (1, 4), (1, 8)]
+    reader.close()
+
+
+def test_live_reopen():
+    writer = LiveDataSet(dirname, 'w')
+    writer[0] = np.zeros((2, 3))
+    writer.close()
+
+    # a follower started after the writer resumes keeps following, even
+    # though nothing new has been published yet
+    writer = LiveDataSet(dirname, 'a')
+    reader = LiveDataSet(dirname)
+    assert not reader.closed
+    followed = []
+    follower = threading.Thread(target=lambda: followed.extend(
+        reader.follow(poll_interval=0.01, timeout=10)))
+    follower.start()
+    writer[1] = np.ones((4, 3))
+    writer.close()
+    follower.join()
+    assert followed == [0, 1]
+    assert reader.closed
+    reader.close()
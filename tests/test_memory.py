@@ -0,0 +1,66 @@
+import os
+import numpy as np
+from msmbuilder3 import MemoryDataSet
+
+
+def test_memory():
+    trajs = [np.random.randn(100, 5) for i in range(4)]
+    nbytes = trajs[0].nbytes
+
+    ds = MemoryDataSet(max_bytes=2 * nbytes)
+    for i, t in enumerate(trajs):
+        ds[i] = t
+        ds.set_trajfn(i, 'traj%d.xtc' % i)
+    assert ds.nbytes <= 2 * nbytes
+    assert ds.spilled_keys() == [0, 1]
+    spill = ds._spill_filename
+    assert os.path.exists(spill)
+
+    # partial reads of spilled trajectories leave them on disk
+    np.testing.assert_array_equal(ds[0, 10:20], trajs[0][10:20])
+    assert ds.spilled_keys() == [0, 1]
+    # reading one back in spills the least recently used one
+    np.testing.assert_array_equal(ds[1], trajs[1])
+    assert ds.spilled_keys() == [0, 2]
+
+    ds.append(0, trajs[0][:5])
+    ds.append(3, trajs[3][:5])
+    trajs[0] = np.concatenate([trajs[0], trajs[0][:5]])
+    trajs[3] = np.concatenate([trajs[3], trajs[3][:5]])
+    np.testing.assert_array_equal(ds.lengths(), [105, 100, 100, 105])
+    for i in range(4):
+        np.testing.assert_array_equal(ds[i], trajs[i])
+        assert ds.get_trajfn(i) == 'traj%d.xtc' % i
+
+    chunks = list(ds.iter_chunks(chunk_size=30, columns=[4, 0]))
+    np.testing.assert_array_equal(np.concatenate([d for k, o, d in chunks]),
+                                  np.concatenate(trajs)[:, [4, 0]])
+    ds.close()
+    assert not os.path.exists(spill)
+
+
+def test_memory_clean_eviction():
+    trajs = [np.random.randn(100, 5) for i in range(4)]
+    ds = MemoryDataSet(max_bytes=2 * trajs[0].nbytes)
+    for i, t in enumerate(trajs):
+        ds[i] = t
+
+    # trajectories read back from disk and not modified are dropped again
+    # without being rewritten
+    writes = []
+    write = ds._spill._write
+    ds._spill._write = lambda key, value, append: writes.append(key) or write(key, value, append)
+    for i in range(4):
+        np.testing.assert_array_equal(ds[i], trajs[i])
+    assert writes == [2, 3]
+    for i in range(4):
+        np.testing.assert_array_equal(ds[i], trajs[i])
+    assert writes == [2, 3]
+
+    # ... unless they were modified
+    ds.append(3, trajs[3][:5])
+    np.testing.assert_array_equal(ds[0], trajs[0])
+    np.testing.assert_array_equal(ds[1], trajs[1])
+    assert writes == [2, 3, 3]
+    np.testing.assert_array_equal(ds[3][100:], trajs[3][:5])
+    ds.close()
@@ -0,0 +1,52 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+from msmbuilder3 import DataSet, NpyDataSet, export_npy, import_npy
+
+
+dirname = None
+def setup():
+    global dirname
+    dirname = tempfile.mkdtemp()
+
+def teardown():
+    shutil.rmtree(dirname)
+
+
+def test_export_import():
+    a = np.random.randn(250, 3).astype(np.float32)
+    b = np.arange(40)
+    fn = os.path.join(dirname, 'in.h5')
+    npy = os.path.join(dirname, 'npy')
+
+    ds = DataSet(fn, 'w', name='npytest')
+    ds[0] = a
+    ds[2] = np.zeros((0, 3))
+    ds[5] = b
+    ds.set_trajfn(5, 'five.xtc')
+    export_npy(ds, npy, chunk_size=64)
+    ds.close()
+
+    np.testing.assert_array_equal(np.load(os.path.join(npy, '0.npy')), a)
+    ds = NpyDataSet(npy)
+    assert ds.name == 'npytest'
+    assert ds.keys() == [0, 2, 5]
+    assert isinstance(ds[0], np.memmap)
+    np.testing.assert_array_equal(ds[0], a)
+    np.testing.assert_array_equal(ds[5, 3:9], b[3:9])
+    assert ds.shape(2) == (0, 3)
+    assert ds.dtype(0) == np.float32
+    assert ds.get_trajfn(5) == 'five.xtc'
+    np.testing.assert_array_equal(ds.lengths(), [250, 0, 40])
+    ds.close()
+
+    ds = import_npy(npy, os.path.join(dirname, 'out.h5'), chunk_size=64, layout='nodes')
+    ds.close()
+    ds = DataSet(os.path.join(dirname, 'out.h5'))
+    assert ds.keys() == [0, 2, 5]
+    np.testing.assert_array_equal(ds[0], a)
+    np.testing.assert_array_equal(ds[5], b)
+    assert ds.shape(2) == (0, 3)
+    assert ds.get_trajfn(5) == 'five.xtc'
+    ds.close()
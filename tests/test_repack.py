@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+from msmbuilder3 import DataSet
+from msmbuilder3.command.repackapp import RepackApp
+
+
+dirname = None
+def setup():
+    global dirname
+    dirname = tempfile.mkdtemp()
+
+def teardown():
+    shutil.rmtree(dirname)
+
+
+def run(*argv):
+    app = RepackApp()
+    app.parse_command_line(list(argv))
+    app.start()
+    return app
+
+
+def test_repack_pyramid():
+    fn = os.path.join(dirname, 'in.h5')
+    out = os.path.join(dirname, 'out.h5')
+    ds = DataSet(fn, 'w', pyramid=(5,))
+    ds[0] = np.arange(300, dtype=np.float32).reshape(100, 3)
+    ds.close()
+
+    for argv, pyramid in [(['--pyramid=10,20'], [10, 20]), (['--pyramid=10'], [10]),
+                          ([], [5]), (['--drop_pyramid=True'], [])]:
+        run('--input=%s' % fn, '--output=%s' % out, *argv)
+        ds = DataSet(out)
+        assert ds.pyramid == pyramid, (argv, ds.pyramid)
+        np.testing.assert_array_equal(ds[0, ::10], np.arange(300).reshape(100, 3)[::10])
+        ds.close()
+
+
+def test_repack_in_place():
+    fn = os.path.join(dirname, 'assignments.h5')
+    ds = DataSet(fn, 'w', encoding='rle')
+    ds[0] = np.repeat(np.arange(5), 20)
+    ds.close()
+    os.chmod(fn, 0o644)
+
+    # the encoding is dropped for the flat layout, and the file keeps its mode
+    run('--input=%s' % fn, '--output=%s' % fn, '--layout=flat')
+    assert os.stat(fn).st_mode & 0o777 == 0o644
+    assert os.listdir(dirname).count('assignments.h5') == 1
+    ds = DataSet(fn)
+    assert ds.layout == 'flat' and ds.encoding is None
+    np.testing.assert_array_equal(ds[0], np.repeat(np.arange(5), 20))
+    ds.close()
+
+    # asking for an encoding with the flat layout is an error, and nothing
+    # is left behind
+    before = sorted(os.listdir(dirname))
+    try:
+        run('--input=%s' % fn, '--output=%s' % fn, '--layout=flat', '--encoding=rle')
+    except SystemExit:
+        pass
+    else:
+        raise AssertionError('expected an error')
+    assert sorted(os.listdir(dirname)) == before
+
+    # so does a failure while copying
+    app = RepackApp()
+    app.parse_command_line(['--input=%s' % fn, '--output=%s' % fn])
+    def fail(input, output, options):
+        raise IOError('disk full')
+    app._repack = fail
+    try:
+        app.start()
+    except IOError:
+        pass
+    else:
+        raise AssertionError('expected an IOError')
+    assert sorted(os.listdir(dirname)) == before
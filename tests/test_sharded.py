@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+from msmbuilder3 import ShardedDataSet
+
+
+dirname = None
+def setup():
+    global dirname
+    dirname = tempfile.mkdtemp()
+
+def teardown():
+    shutil.rmtree(dirname)
+
+
+def test_sharded():
+    fn = os.path.join(dirname, 'sharded.json')
+    trajs = dict((i, np.random.randn(i + 3, 2)) for i in range(7))
+
+    # independent writers, one per shard
+    for shard in range(3):
+        ds = ShardedDataSet(fn, 'w', n_shards=3, shard=shard)
+        for i in range(shard, 7, 3):
+            ds[i] = trajs[i]
+            ds.set_trajfn(i, 'traj%d.xtc' % i)
+        try:
+            ds[(shard + 1) % 3] = trajs[0]
+        except KeyError:
+            pass
+        else:
+            raise AssertionError('expected KeyError')
+        ds.close()
+    assert sorted(os.listdir(dirname)) == ['sharded.json'] + \
+        ['sharded.shard%d.h5' % i for i in range(3)]
+
+    ds = ShardedDataSet(fn)
+    assert ds.n_shards == 3
+    assert ds.keys() == range(7)
+    for i in range(7):
+        np.testing.assert_array_equal(ds[i], trajs[i])
+        assert ds.get_trajfn(i) == 'traj%d.xtc' % i
+    np.testing.assert_array_equal(ds[4, 1:3], trajs[4][1:3])
+    np.testing.assert_array_equal(ds.lengths(), np.arange(7) + 3)
+    np.testing.assert_array_equal(ds.offsets()[-1], sum(len(t) for t in trajs.values()))
+
+    chunks = list(ds.iter_chunks(chunk_size=4, prefetch=2))
+    assert [k for k, o, d in chunks if o == 0] == range(7)
+    np.testing.assert_array_equal(np.concatenate([d for k, o, d in chunks]),
+                                  np.concatenate([trajs[i] for i in range(7)]))
+    ds.close()
+
+    # a reader can open just one shard
+    ds = ShardedDataSet(fn, shard=1)
+    assert ds.keys() == [1, 4]
+    ds.close()
@@ -0,0 +1,17 @@
+import numpy as np
+from msmbuilder3 import tICA, set_precision, get_precision
+
+
+def test_tica_precision():
+    data = np.random.randn(1000, 5).astype(np.float32)
+    tica = tICA(lag=1, n_components=2).fit_update(data)
+    # the running sums are double precision, the projection single precision
+    assert tica.running_corr_mat_0_dt_.dtype == np.float64
+    assert tica.transform(data).dtype == np.float32
+
+    assert get_precision() == 'single'
+    set_precision('double')
+    try:
+        assert tica.transform(data).dtype == np.float64
+    finally:
+        set_precision('single')
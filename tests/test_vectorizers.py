@@ -34,9 +34,21 @@ def test_dihedral_vectorizer():
 def test_position_vectorizer():
     reference = np.array(map(lambda xyz: md.geometry.alignment.transform(xyz, t.xyz[0]), t.xyz))
     result = PositionVectorizer(t).transform(t)
-    np.testing.assert_array_equal(result, reference.reshape((t.n_frames, t.n_atoms*3)))
+    assert result.dtype == np.float32
+    np.testing.assert_array_almost_equal(result, reference.reshape((t.n_frames, t.n_atoms*3)),
+                                         decimal=4)
 
     t2 = PositionVectorizer(t).inverse_transform(result)
     assert isinstance(t2, md.Trajectory)
     for i in range(t.n_frames):
         assert md.geometry.alignment.rmsd_qcp(t.xyz[i], t2.xyz[i]) < 1e-3
+
+
+def test_position_vectorizer_alignment_indices():
+    # align on the first ten atoms, but move all of them
+    indices = np.arange(10)
+    result = PositionVectorizer(t, indices).transform(t).reshape(t.n_frames, t.n_atoms, 3)
+    for i in range(t.n_frames):
+        aligned = md.geometry.alignment.transform(t.xyz[i, indices], t.xyz[0, indices])
+        np.testing.assert_array_almost_equal(result[i, indices], aligned, decimal=4)
+        assert md.geometry.alignment.rmsd_qcp(t.xyz[i], result[i]) < 1e-3
@@ -0,0 +1,54 @@
+import os
+import tempfile
+import multiprocessing
+import numpy as np
+from msmbuilder3 import DataSet, DataSetWriter
+
+
+fn = None
+def setup():
+    global fn
+    fn = tempfile.mkstemp()[1]
+
+def teardown():
+    os.unlink(fn)
+
+
+def _produce(writer, start):
+    for i in range(start, 12, 3):
+        rs = np.random.RandomState(i)
+        writer.put(i, rs.randn(10 * i + 1, 4), trajfn='traj%d.xtc' % i)
+    if start == 0:
+        writer.put(0, np.ones((2, 4)), append=True)
+
+
+def test_writer():
+    writer = DataSetWriter(fn, max_pending=2, batch_size=5, shm_threshold=1000)
+    producers = [multiprocessing.Process(target=_produce, args=(writer, i)) for i in range(3)]
+    for p in producers:
+        p.start()
+    for p in producers:
+        p.join()
+    writer.close()
+
+    ds = DataSet(fn)
+    assert ds.keys() == range(12)
+    for i in range(1, 12):
+        np.testing.assert_array_equal(ds[i], np.random.RandomState(i).randn(10 * i + 1, 4))
+        assert ds.get_trajfn(i) == 'traj%d.xtc' % i
+    np.testing.assert_array_equal(ds[0, 1:], np.ones((2, 4)))
+    ds.close()
+
+
+def test_writer_error():
+    writer = DataSetWriter(fn)
+    writer.put(0, np.zeros(3))
+    writer.put(2, np.float64(1))
+    writer.put(1, np.zeros(100000))
+    try:
+        writer.close()
+    except RuntimeError as e:
+        assert 'at least one dimensional' in str(e)
+    else:
+        raise AssertionError('expected RuntimeError')
+    assert not [f for f in os.listdir('/dev/shm') if f.startswith('msmb-writer-')]